@@ -0,0 +1,7 @@
+"""
+Preprocessing of whole-slide images and their ASAP annotations.
+
+Modules are imported on demand, `import data_utils` alone loads nothing heavy. Command line entry point:
+
+    python -m data_utils {convert,stats,extract,overlays} ...
+"""
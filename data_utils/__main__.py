@@ -0,0 +1,57 @@
+import argparse
+
+from .data_config import *
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m data_utils')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='convert the dataset slides to downscaled images')
+    convert_parser.add_argument('--scale-factors', type=float, nargs='+', default=None,
+                                help='defaults to HISTOPATH_SCALE_FACTORS or ARGS_scale_factor')
+    convert_parser.add_argument('--format', default=None, help='png, jpg or tiff, defaults to HISTOPATH_CONVERT_FORMAT or ARGS_convert_image_format')
+    convert_parser.add_argument('--threads', type=int, default=0)
+    convert_parser.add_argument('--force', action='store_true')
+
+    stats_parser = subparsers.add_parser('stats', help='dataset statistics of the raw slides (scale factor 0) or converted images')
+    stats_parser.add_argument('--scale-factor', type=float, default=ARGS_scale_factor)
+    stats_parser.add_argument('--format', default=None, help='format of the converted images, defaults to HISTOPATH_CONVERT_FORMAT or ARGS_convert_image_format')
+    stats_parser.add_argument('--threads', type=int, default=0)
+
+    extract_parser = subparsers.add_parser('extract', help='extract labeled tissue patches into tar shards')
+    extract_parser.add_argument('--level', type=int, default=ARGS_patch_level)
+    extract_parser.add_argument('--patch-size', type=int, default=ARGS_patch_size)
+    extract_parser.add_argument('--stride', type=int, default=ARGS_patch_stride)
+    extract_parser.add_argument('--threads', type=int, default=0)
+    extract_parser.add_argument('--force', action='store_true')
+
+    overlays_parser = subparsers.add_parser('overlays', help='annotation overlay thumbnails of the annotated slides')
+    overlays_parser.add_argument('--max-size', type=int, default=ARGS_overlay_max_size)
+    overlays_parser.add_argument('--threads', type=int, default=0)
+    overlays_parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+
+    # whole scales name the output dirs 16X rather than 16.0X
+    as_scale = lambda value: int(value) if value == int(value) else value
+    if args.command == 'convert':
+        from .slide_converter import ConvertConfig, convert_all_slides
+        scale_factors = [as_scale(value) for value in args.scale_factors] if args.scale_factors is not None else None
+        config = ConvertConfig(scale_factors=scale_factors, image_format=args.format)
+        convert_all_slides(num_thread=args.threads, force_reconvert=args.force, config=config)
+    elif args.command == 'stats':
+        from .slide_converter import ConvertConfig, get_stats
+        get_stats(as_scale(args.scale_factor), args.threads, ConvertConfig(image_format=args.format))
+    elif args.command == 'extract':
+        from .patch_extractor import extract_all_slides
+        # the output dir follows the grid, see patch_extractor.get_patch_dir
+        extract_all_slides(args.threads, force_reextract=args.force,
+                            level=args.level, patch_size=args.patch_size, stride=args.stride)
+    elif args.command == 'overlays':
+        from .annotation import save_all_overlay_thumbnails
+        save_all_overlay_thumbnails(args.threads, max_size=args.max_size, force=args.force,
+                                    output_dir=pjoin(os.path.dirname(ARGS_overlay_dir), f'{args.max_size}px'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,21 @@
 from math import isclose
+import os
+import multiprocessing
 import numpy as np
-import cv2
+from PIL import Image
 
-import utils
-from slide import Slide
-from data_config import *
+from . import utils
+from . import metrics
+from .slide import Slide
+from .annotation_index import AnnotationIndex
+from .polygon_raster import fill_polygon_window
+from .data_config import *
 
 COLORS = [(178, 34, 34), (0, 128, 0)]
 GRAY_SCALE_COLORS = [128,255]
+# label mask values: annotation label + 1 where annotated
+BACKGROUND_LABEL = 0
+NUM_LABELS = 3
 
 class Annotation:
     def __init__(self, path):
@@ -16,47 +24,47 @@ class Annotation:
         self.ASAP_Annotations = utils.open_annotation(path)
         self.AnnotationGroups = self._get_annoation_groups()
         self.Annotations = self._get_annotations()
+        self.index = AnnotationIndex(self.Annotations)
+        self._scaled_shapes = {}
 
     def _get_annoation_groups(self):
         groups_list = []
-        for groups in self.ASAP_Annotations.getElementsByTagName('AnnotationGroups'):
-            for group in groups.getElementsByTagName('Group'):
-                name = group.getAttribute('Name')
-                assert name in ['positive', 'Positive', '1', 'pos', 'negative', 'Negative', '0', 'neg']
-                assert group.getAttribute('PartOfGroup') == 'None'
-                groups_list.append(name)
+        for name, parent in zip(self.ASAP_Annotations['group_names'], self.ASAP_Annotations['group_parents']):
+            name = str(name)
+            assert name in ['positive', 'Positive', '1', 'pos', 'negative', 'Negative', '0', 'neg']
+            assert parent == 'None'
+            groups_list.append(name)
         return groups_list
     
 
     def _get_annotations(self):
         annotations_list = []
-        for annotations in self.ASAP_Annotations.getElementsByTagName('Annotations'):
-            for annotation in annotations.getElementsByTagName('Annotation'):
-                annotation_dict = {'name': annotation.getAttribute('Name'),
-                                    'type': annotation.getAttribute('Type'),
-                                    'label': annotation.getAttribute('PartOfGroup'),
-                                    'coordinates': None,
-                                    'bbox': None}
-                assert annotation_dict['type'] in ['Rectangle', 'Spline', 'Polygon']
-                if annotation_dict['label'] in ['Positive', 'positive', '1', 'pos']:
-                    annotation_dict['label'] = 1
-                elif annotation_dict['label'] in ['Negative', 'negative', '0', 'neg', 'None']:
-                    annotation_dict['label'] = 0
-                else:
-                    raise ValueError(f'Annotation{annotation_dict["name"]} wrong PartOfGroup: {annotation_dict["label"]}')
+        offsets = self.ASAP_Annotations['offsets']
+        coordinates = np.maximum(self.ASAP_Annotations['coordinates'], 0)
+        for idx, (name, annotation_type, label) in enumerate(zip(self.ASAP_Annotations['annotation_names'],
+                                                                self.ASAP_Annotations['annotation_types'],
+                                                                self.ASAP_Annotations['annotation_parents'])):
+            annotation_dict = {'name': str(name),
+                                'type': str(annotation_type),
+                                'label': str(label),
+                                'coordinates': None,
+                                'bbox': None}
+            assert annotation_dict['type'] in ['Rectangle', 'Spline', 'Polygon']
+            if annotation_dict['label'] in ['Positive', 'positive', '1', 'pos']:
+                annotation_dict['label'] = 1
+            elif annotation_dict['label'] in ['Negative', 'negative', '0', 'neg', 'None']:
+                annotation_dict['label'] = 0
+            else:
+                raise ValueError(f'Annotation{annotation_dict["name"]} wrong PartOfGroup: {annotation_dict["label"]}')
 
-                coordinate_list = []
-                for coordinate in annotation.getElementsByTagName('Coordinate'):
-                    coordinate_list.append([max(float(coordinate.getAttribute('X')), 0), 
-                                            max(float(coordinate.getAttribute('Y')), 0)])
-                coordinate_list = np.asarray(coordinate_list)
-                annotation_dict['coordinates'] = coordinate_list
+            coordinate_list = coordinates[offsets[idx]:offsets[idx+1]]
+            annotation_dict['coordinates'] = coordinate_list
 
-                bbox = ((np.min(coordinate_list[:, 0]), np.min(coordinate_list[:, 1])), 
-                            (np.max(coordinate_list[:, 0]), np.max(coordinate_list[:, 1])))
-                annotation_dict['bbox'] = bbox
+            bbox = ((np.min(coordinate_list[:, 0]), np.min(coordinate_list[:, 1])), 
+                        (np.max(coordinate_list[:, 0]), np.max(coordinate_list[:, 1])))
+            annotation_dict['bbox'] = bbox
 
-                annotations_list.append(annotation_dict)
+            annotations_list.append(annotation_dict)
         return annotations_list
 
     def get_thumbnail_array(self):
@@ -69,30 +77,195 @@ class Annotation:
         else:
             image = self.slide.pil_image(scale_factor=scale_factor)
             scale_factor = self.slide.dimensions[0] / image.size[0]
-        image_array = np.asarray(image)
-        for annotation in self.Annotations:
-            pt1 = tuple([round(value/scale_factor) for value in annotation['bbox'][0]])
-            pt2 = tuple([round(value/scale_factor) for value in annotation['bbox'][1]])
-            cv2.rectangle(image_array, pt1=pt1, pt2=pt2, color=COLORS[annotation['label']], thickness=round(100/scale_factor))
+        image_array = np.array(image)
+        self._draw_overlay(image_array, range(len(self.Annotations)), scale_factor)
+        return image_array
+
+    def _draw_overlay(self, image_array, annotation_ids, scale_factor, offset=(0, 0)):
+        # bbox and outline of each annotation; offset is the position of image_array in the scaled slide
+        import cv2
+        thickness = max(round(100/scale_factor), 1)
+        offset = np.array(offset, dtype=np.int32)
+        for idx in annotation_ids:
+            annotation = self.Annotations[idx]
+            pt1 = np.array([round(value/scale_factor) for value in annotation['bbox'][0]], dtype=np.int32) - offset
+            pt2 = np.array([round(value/scale_factor) for value in annotation['bbox'][1]], dtype=np.int32) - offset
+            cv2.rectangle(image_array, pt1=tuple(pt1.tolist()), pt2=tuple(pt2.tolist()), color=COLORS[annotation['label']], thickness=thickness)
             if annotation['type'] != 'Rectangle':
-                pts = np.array([annotation['coordinates']/scale_factor], dtype=np.int32)
-                cv2.polylines(image_array,  pts=pts, isClosed=True, color=COLORS[annotation['label']], thickness=round(100/scale_factor))
+                pts = np.array([annotation['coordinates']/scale_factor], dtype=np.int32) - offset
+                cv2.polylines(image_array, pts=pts, isClosed=True, color=COLORS[annotation['label']], thickness=thickness)
+
+    def get_annotated_region(self, location, size, level):
+        """
+        (H, W, 3) tile of `level` at the level-0 `location`, with the outlines of the annotations crossing it.
+        Only the tile is read and only the annotations whose bbox meets it are drawn. OpenCV clips outlines
+        at the tile border, so they may be a pixel off there compared with a full-slide render.
+        """
+        if isinstance(size, int):
+            size = (size, size)
+        downsample = self.slide.metadata['level_downsamples'][level]
+        image_array = np.array(self.slide.get_tile(location, size, level))
+        # outlines are drawn centered on the shape border, so shapes just outside the tile may reach into it
+        margin = (max(round(100/downsample), 1) + 1) * downsample
+        annotation_ids = self.index.query(upper_left=(location[0]-margin, location[1]-margin),
+                                            lower_right=(location[0]+size[0]*downsample+margin, location[1]+size[1]*downsample+margin))
+        self._draw_overlay(image_array, annotation_ids, downsample,
+                            offset=(round(location[0]/downsample), round(location[1]/downsample)))
         return image_array
 
-    def get_mask_image(self, scale_factor, include_bbox=False):
+    def get_overlay_thumbnail(self, max_size=ARGS_overlay_max_size):
+        """
+        Whole slide with its annotations, read from the coarsest level that is still at least max_size
+        on the longest side and downsized to it.
+        """
+        downsample = max(self.slide.dimensions) / max_size
+        level = self.slide.slide.get_best_level_for_downsample(max(downsample, 1))
+        image_array = self.get_annotated_region((0, 0), self.slide.level_dimensions[level], level)
+        image = Image.fromarray(image_array)
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        return image
+
+    def _get_scaled_shapes(self, scale_factor):
+        """
+        Integer vertices of every annotation at scale_factor, computed once per scale: the polygon points
+        for Spline/Polygon and the two bbox corners for Rectangle, aligned with self.Annotations.
+        """
+        if scale_factor not in self._scaled_shapes:
+            shapes = []
+            for annotation in self.Annotations:
+                if annotation['type'] == 'Rectangle':
+                    shapes.append(np.array([[round(value/scale_factor) for value in point] for point in annotation['bbox']], dtype=np.int32))
+                else:
+                    shapes.append(np.array(annotation['coordinates']/scale_factor, dtype=np.int32))
+            self._scaled_shapes[scale_factor] = shapes
+        return self._scaled_shapes[scale_factor]
+
+    def _get_drawing_order(self, annotation_ids, priority):
+        # later annotations are drawn over earlier ones; sorting is stable so the file order breaks ties
+        if priority == 'order':
+            return list(annotation_ids)
+        elif priority in ['positive', 'negative']:
+            winner = 1 if priority == 'positive' else 0
+            return sorted(annotation_ids, key=lambda idx: self.Annotations[idx]['label'] == winner)
+        raise ValueError(f'priority should be order, positive or negative, got {priority}')
+
+    def _draw_shape(self, mask_array, idx, shapes, color, offset=(0, 0)):
+        import cv2
+        annotation, shape = self.Annotations[idx], shapes[idx]
+        if annotation['type'] == 'Rectangle':
+            cv2.rectangle(mask_array, pt1=tuple((shape[0]-offset).tolist()), pt2=tuple((shape[1]-offset).tolist()), color=color, thickness=-1)
+        else:
+            cv2.fillPoly(mask_array, np.array([shape-offset], dtype=np.int32), color=color)
+
+    def _is_drawn(self, idx, include_bbox):
+        return self.Annotations[idx]['type'] in ['Spline', 'Polygon'] or include_bbox
+
+    def get_label_mask(self, scale_factor, include_bbox=False, priority='order'):
+        """
+        Label-indexed mask at scale_factor: BACKGROUND_LABEL where nothing is annotated, otherwise
+        annotation label + 1. priority decides overlaps: 'order' keeps the file order (last wins),
+        'positive'/'negative' draw that label over the other.
+        """
         mask_array_dimensions = [round(value/scale_factor) for value in reversed(self.slide.dimensions)]
-        mask_array = np.zeros(mask_array_dimensions, dtype=np.uint8)
-        for annotation in self.Annotations:
-            if annotation['type'] in ['Spline', 'Polygon']:
-                pts = np.array([annotation['coordinates']/scale_factor], dtype=np.int32)
-                cv2.fillPoly(mask_array, pts, color=GRAY_SCALE_COLORS[annotation['label']])
-            elif annotation['type'] == 'Rectangle' and include_bbox:
-                pt1 = tuple([round(value/scale_factor) for value in annotation['bbox'][0]])
-                pt2 = tuple([round(value/scale_factor) for value in annotation['bbox'][1]])
-                cv2.rectangle(mask_array, pt1=pt1, pt2=pt2, color=GRAY_SCALE_COLORS[annotation['label']], thickness=-1)
+        mask_array = np.full(mask_array_dimensions, BACKGROUND_LABEL, dtype=np.uint8)
+        shapes = self._get_scaled_shapes(scale_factor)
+        annotation_ids = [idx for idx in range(len(self.Annotations)) if self._is_drawn(idx, include_bbox)]
+        with metrics.timer('rasterize'):
+            for idx in self._get_drawing_order(annotation_ids, priority):
+                self._draw_shape(mask_array, idx, shapes, color=self.Annotations[idx]['label']+1)
+        metrics.count('shapes_rasterized', len(annotation_ids))
+        return mask_array
+
+    def get_level_label_mask(self, level, include_bbox=False, priority='order'):
+        return self.get_label_mask(self.slide.metadata['level_downsamples'][level], include_bbox, priority)
+
+    def get_mask_image(self, scale_factor, include_bbox=False):
+        label_mask = self.get_label_mask(scale_factor, include_bbox)
+        return np.array([0] + GRAY_SCALE_COLORS, dtype=np.uint8)[label_mask]
+
+    def get_window_label_fractions(self, upper_lefts, window_size, scale_factor, include_bbox=False, priority='order'):
+        """
+        Area fraction of every label (background, negative, positive) inside level-0 windows,
+        as an (N, 3) array, from integral images of the label mask at scale_factor.
+        Windows are widened to the mask pixels they touch, so a coarser scale_factor trades accuracy for memory.
+        """
+        label_mask = self.get_label_mask(scale_factor, include_bbox, priority)
+        upper_lefts = np.asarray(upper_lefts).reshape(-1, 2)
+        fractions = np.empty((len(upper_lefts), NUM_LABELS), dtype=np.float64)
+        for label in range(NUM_LABELS):
+            fractions[:, label] = utils.get_window_fractions(label_mask == label, (scale_factor, scale_factor),
+                                                                upper_lefts, window_size)
+        return fractions
+
+    def get_patch_label_fractions(self, level, patch_size, stride, scale_factor=None, include_bbox=False, priority='order'):
+        """
+        Level-0 upper-left corners of the patch grid at `level` and their (N, 3) label fractions,
+        computed in one pass from a mask at scale_factor (the level downsample by default).
+        """
+        downsample = self.slide.metadata['level_downsamples'][level]
+        upper_lefts = utils.get_grid_positions(self.slide.level_dimensions[level], downsample, patch_size, stride)
+        fractions = self.get_window_label_fractions(upper_lefts, (patch_size*downsample,)*2,
+                                                    scale_factor if scale_factor is not None else downsample,
+                                                    include_bbox, priority)
+        return upper_lefts, fractions
+
+    def get_mask_region(self, upper_left, lower_right, scale_factor=1, include_bbox=False):
+        """
+        Equals get_mask_image(scale_factor, include_bbox)[upper_left[1]:lower_right[1], upper_left[0]:lower_right[0]]
+        without allocating the whole mask: only annotations whose bbox overlaps the window are rasterized,
+        and only inside the window, so the cost is O(window + their vertices). Polygons crossing the mask
+        border are the exception, they are drawn into their bbox clipped to the mask, see below.
+        """
+        mask_height, mask_width = [round(value/scale_factor) for value in reversed(self.slide.dimensions)]
+        upper_left = (max(upper_left[0], 0), max(upper_left[1], 0))
+        lower_right = (min(lower_right[0], mask_width), min(lower_right[1], mask_height))
+        mask_array = np.zeros((max(lower_right[1]-upper_left[1], 0), max(lower_right[0]-upper_left[0], 0)), dtype=np.uint8)
+        if mask_array.size == 0:
+            return mask_array
+
+        shapes = self._get_scaled_shapes(scale_factor)
+        annotation_ids = self.index.query(upper_left=((upper_left[0]-1)*scale_factor, (upper_left[1]-1)*scale_factor),
+                                            lower_right=((lower_right[0]+1)*scale_factor, (lower_right[1]+1)*scale_factor))
+        for idx in annotation_ids:
+            if not self._is_drawn(idx, include_bbox):
+                continue
+            (x0, y0), (x1, y1) = shapes[idx].min(axis=0), shapes[idx].max(axis=0)
+            inside_mask = x0 >= 0 and y0 >= 0 and x1 < mask_width and y1 < mask_height
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, mask_width-1), min(y1, mask_height-1)
+            window_x0, window_y0 = max(x0, upper_left[0]), max(y0, upper_left[1])
+            window_x1, window_y1 = min(x1+1, lower_right[0]), min(y1+1, lower_right[1])
+            if window_x0 >= window_x1 or window_y0 >= window_y1:
+                continue
+
+            with metrics.timer('rasterize'):
+                if self.Annotations[idx]['type'] == 'Rectangle':
+                    # filled rectangles cover their bbox, corners included
+                    shape_window = np.ones((window_y1-window_y0, window_x1-window_x0), dtype=bool)
+                elif inside_mask:
+                    shape_window = fill_polygon_window(shapes[idx], (window_x0, window_y0), (window_x1, window_y1))
+                else:
+                    # OpenCV rebuilds the edges cut by the image border, so a polygon crossing the mask border
+                    # is drawn the same way as in the full mask: into its bbox, clipped to the mask only
+                    shape_array = np.zeros((y1-y0+1, x1-x0+1), dtype=np.uint8)
+                    self._draw_shape(shape_array, idx, shapes, color=1, offset=np.array((x0, y0), dtype=np.int32))
+                    shape_window = shape_array[window_y0-y0:window_y1-y0, window_x0-x0:window_x1-x0] > 0
+            metrics.count('shapes_rasterized')
+            mask_window = mask_array[window_y0-upper_left[1]:window_y1-upper_left[1], window_x0-upper_left[0]:window_x1-upper_left[0]]
+            mask_window[shape_window] = GRAY_SCALE_COLORS[self.Annotations[idx]['label']]
         return mask_array
 
+    def get_annotations_in_region(self, upper_left, lower_right):
+        return self.index.annotations_in_region(upper_left, lower_right)
+
+    def get_labels_at(self, points, include_bbox=False):
+        return self.index.labels_at(points, include_bbox)
+
     def get_mask_tile(self, position, size, include_bbox=False):
+        """
+        Level-0 mask tile, identical to slicing get_mask_image(1, include_bbox). Memory and time are O(tile) plus
+        the vertices of the overlapping annotations, except for polygons crossing the slide border, which
+        cost their bbox.
+        """
         if isinstance(size, int):
             size = (size, size)
         elif not (isinstance(size, tuple) or isinstance(size, list)):
@@ -101,9 +274,10 @@ class Annotation:
         if position[0] > self.slide.dimensions[0] or position[1] > self.slide.dimensions[1]:
             raise OverflowError(f'Required position {position} is out of slide_dimensions {self.slide.dimensions}')
 
-        mask_array = self.get_mask_image(1, include_bbox)
-        mask_tile_array = mask_array[position[0]:position[0]+size[0], position[1]:position[1]+size[1]]
-        return mask_tile_array
+        # position and size index (row, column) of the level-0 mask
+        return self.get_mask_region(upper_left=(position[1], position[0]),
+                                    lower_right=(position[1]+size[1], position[0]+size[0]),
+                                    include_bbox=include_bbox)
         
     def get_annotated_image_tile(self, position, size, level):
         if isinstance(size, int):
@@ -114,8 +288,55 @@ class Annotation:
         if position[0] > self.slide.level_dimensions[level][0] or position[1] > self.slide.level_dimensions[level][1]:
             raise OverflowError(f'Required position {position} is out of dimension of level {level}: {self.slide.level_dimensions[level]}')
 
-        image_array = self.get_annotated_array(self.slide.level_downsamples[level])
-        tile_array = image_array[position[0]:position[0]+size[0], position[1]:position[1]+size[1], :]
-        return tile_array
+        # position and size index (row, column) of the level image
+        downsample = self.slide.metadata['level_downsamples'][level]
+        return self.get_annotated_region(location=(round(position[1]*downsample), round(position[0]*downsample)),
+                                            size=(size[1], size[0]), level=level)
+
+
+def _overlay_is_current(overlay_path, filepath):
+    if not os.path.exists(overlay_path):
+        return False
+    overlay_mtime = os.path.getmtime(overlay_path)
+    return all(overlay_mtime >= os.path.getmtime(path)
+                for path in [utils.get_raw_item_fullpath(filepath), utils.get_annotation_fullpath(filepath)])
+
+
+def save_overlay_thumbnail(filepath, max_size=ARGS_overlay_max_size, output_dir=ARGS_overlay_dir, force=False):
+    """
+    Write the annotation overlay thumbnail of a slide as a PNG, skipped while it is newer than
+    both the slide and its annotation file.
+    """
+    overlay_path = pjoin(output_dir, os.path.splitext(filepath)[0] + '.png')
+    if not force and _overlay_is_current(overlay_path, filepath):
+        return overlay_path
+    utils.exists_or_makedirs(os.path.dirname(overlay_path))
+    utils.atomic_save_image(Annotation(filepath).get_overlay_thumbnail(max_size), overlay_path)
+    return overlay_path
+
+
+def _overlay_worker(args):
+    filepath, max_size, output_dir, force = args
+    try:
+        return filepath, save_overlay_thumbnail(filepath, max_size, output_dir, force), None
+    except Exception as e:
+        return filepath, None, repr(e)
+
+
+def save_all_overlay_thumbnails(num_thread=0, max_size=ARGS_overlay_max_size, output_dir=ARGS_overlay_dir, force=False):
+    timer = utils.Time()
+    filepath_list = utils.get_dataset_item_list(annotated=True)
+    num_thread = multiprocessing.cpu_count() if num_thread==0 else num_thread
+    num_thread = max(min(num_thread, len(filepath_list)), 1)
+    print(f"Number of processes: {num_thread}")
+    print(f"Number of annotated slides: {len(filepath_list)}")
 
+    with multiprocessing.Pool(num_thread) as pool:
+        results = list(pool.imap_unordered(_overlay_worker, [(filepath, max_size, output_dir, force) for filepath in filepath_list]))
 
+    failed = [(filepath, error) for filepath, _, error in results if error is not None]
+    print(f"Overlays of {len(results) - len(failed)} slides in {output_dir}, {len(failed)} failed")
+    for filepath, error in failed:
+        print(f"\t{filepath}: {error}")
+    timer.elapsed_display()
+    return {filepath: overlay_path for filepath, overlay_path, _ in results}
@@ -0,0 +1,101 @@
+import math
+import numpy as np
+
+
+class AnnotationIndex:
+    """
+    Uniform grid over the level-0 bboxes of ASAP annotations.
+
+    Annotation ids are positions in the list the index was built from, and queries return them in
+    that order so that "last annotation wins" matches the drawing order of Annotation.get_mask_image.
+    """
+
+    def __init__(self, annotations, cell_size=4096):
+        self.annotations = annotations
+        self.cell_size = cell_size
+        self.bboxes = np.array([[*annotation['bbox'][0], *annotation['bbox'][1]] for annotation in annotations],
+                                dtype=np.float64).reshape(-1, 4)
+        self.labels = np.array([annotation['label'] for annotation in annotations], dtype=np.int8)
+        self._paths = [None] * len(annotations)
+
+        self.grid = {}
+        for idx, (x0, y0, x1, y1) in enumerate(self.bboxes):
+            for cell in self._cells((x0, y0), (x1, y1)):
+                self.grid.setdefault(cell, []).append(idx)
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def _cells(self, upper_left, lower_right):
+        cx0, cy0 = math.floor(upper_left[0]/self.cell_size), math.floor(upper_left[1]/self.cell_size)
+        cx1, cy1 = math.floor(lower_right[0]/self.cell_size), math.floor(lower_right[1]/self.cell_size)
+        return [(cx, cy) for cy in range(cy0, cy1+1) for cx in range(cx0, cx1+1)]
+
+    def _path(self, idx):
+        if self._paths[idx] is None:
+            from matplotlib.path import Path
+            self._paths[idx] = Path(self.annotations[idx]['coordinates'])
+        return self._paths[idx]
+
+    def _contains(self, idx, points, include_bbox):
+        annotation = self.annotations[idx]
+        x0, y0, x1, y1 = self.bboxes[idx]
+        inside = (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+        if annotation['type'] == 'Rectangle':
+            return inside if include_bbox else np.zeros(len(points), dtype=bool)
+        if inside.any():
+            inside[inside] = self._path(idx).contains_points(points[inside])
+        return inside
+
+    def query(self, upper_left, lower_right):
+        """
+        Ids of the annotations whose bbox intersects the level-0 rectangle [upper_left, lower_right].
+        """
+        candidates = set()
+        for cell in self._cells(upper_left, lower_right):
+            candidates.update(self.grid.get(cell, ()))
+        candidates = np.array(sorted(candidates), dtype=np.int64)
+        if len(candidates) == 0:
+            return []
+        bboxes = self.bboxes[candidates]
+        hit = ((bboxes[:, 0] <= lower_right[0]) & (bboxes[:, 2] >= upper_left[0])
+                & (bboxes[:, 1] <= lower_right[1]) & (bboxes[:, 3] >= upper_left[1]))
+        return candidates[hit].tolist()
+
+    def annotations_in_region(self, upper_left, lower_right):
+        return [self.annotations[idx] for idx in self.query(upper_left, lower_right)]
+
+    def label_at(self, point, include_bbox=False):
+        """
+        Label (0/1) of the last annotation containing the level-0 point, -1 when it is not annotated.
+        """
+        return int(self.labels_at(np.array([point], dtype=np.float64), include_bbox)[0])
+
+    def labels_at(self, points, include_bbox=False):
+        """
+        Vectorized label_at for an (N, 2) array of level-0 points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        labels = np.full(len(points), -1, dtype=np.int8)
+        if len(points) == 0 or len(self) == 0:
+            return labels
+
+        # bucket the points by grid cell so each annotation only tests the points of its own cells
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        order = np.lexsort((cells[:, 0], cells[:, 1]))
+        sorted_cells = cells[order]
+        boundaries = np.flatnonzero(np.any(np.diff(sorted_cells, axis=0) != 0, axis=1)) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(points)]])
+        point_buckets = {tuple(sorted_cells[start]): order[start:end] for start, end in zip(starts, ends)}
+
+        annotation_points = {}
+        for cell, point_ids in point_buckets.items():
+            for idx in self.grid.get(cell, ()):
+                annotation_points.setdefault(idx, []).append(point_ids)
+
+        for idx in sorted(annotation_points):
+            point_ids = np.concatenate(annotation_points[idx])
+            inside = self._contains(idx, points[point_ids], include_bbox)
+            labels[point_ids[inside]] = self.labels[idx]
+        return labels
@@ -0,0 +1,248 @@
+import argparse
+import math
+import multiprocessing
+import time
+import numpy as np
+
+from .data_config import *
+from .slide import Slide
+from .annotation_index import AnnotationIndex
+from .tile_cache import TileCache
+from .patch_dataset import PatchDataset
+from . import utils
+
+
+def benchmark_region_reader(slide_path, raw_size=8192, tile_size=1024, num_workers_list=(1, 2, 4, 8), repeat=3):
+    slide = Slide(slide_path)
+    if isinstance(raw_size, int):
+        raw_size = (raw_size, raw_size)
+    raw_size = (min(raw_size[0], slide.dimensions[0]), min(raw_size[1], slide.dimensions[1]))
+    raw_location = ((slide.dimensions[0]-raw_size[0])//2, (slide.dimensions[1]-raw_size[1])//2)
+    tile_count = math.ceil(raw_size[0]/tile_size) * math.ceil(raw_size[1]/tile_size)
+
+    print(f'[{slide_path}] region {raw_size} at {raw_location}, {tile_count} tiles of {tile_size}')
+    results = {}
+    for num_workers in num_workers_list:
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            slide.get_fullsize_region_by_tile(raw_location, raw_size, tile_size=tile_size, num_workers=num_workers)
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        results[num_workers] = tile_count / best
+        print(f'\tworkers {num_workers:>3}: {best:.3f}s, {results[num_workers]:.1f} tiles/sec, '
+              f'{results[num_workers]/results[num_workers_list[0]]:.2f}x')
+    return results
+
+
+def benchmark_tile_cache(slide_path, patch_size=256, stride=128, raw_size=8192, cache_bytes=ARGS_tile_cache_bytes,
+                            cache_tile_size=ARGS_tile_cache_tile_size):
+    """
+    Overlapping-stride patch reads over a level-0 region, straight from OpenSlide and through a TileCache.
+    """
+    results = {}
+    for name, tile_cache in [('uncached', None), ('cached', TileCache(cache_bytes, cache_tile_size))]:
+        slide = Slide(slide_path, tile_cache=tile_cache)
+        width, height = min(raw_size, slide.dimensions[0]), min(raw_size, slide.dimensions[1])
+        positions = [(x, y) for y in range(0, height-patch_size+1, stride) for x in range(0, width-patch_size+1, stride)]
+        start = time.perf_counter()
+        for position in positions:
+            slide.get_fullsize_tile(position, patch_size)
+        results[name] = len(positions) / (time.perf_counter() - start)
+        print(f'\t{name:>8}: {results[name]:.1f} patches/sec' + (f', {tile_cache.stats()}' if tile_cache is not None else ''))
+    print(f'\tspeedup {results["cached"]/results["uncached"]:.2f}x')
+    return results
+
+
+def _init_dataset_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _read_dataset_batch(indices):
+    return len(_worker_dataset.get_batch(indices))
+
+
+def benchmark_patch_dataset(filepath_list, level=0, patch_size=256, num_patches=4096, batch_size=64,
+                            num_workers_list=(0, 1, 2, 4, 8), seed=0):
+    """
+    PatchDataset throughput in patches/sec for a number of worker processes, 0 reading in this process.
+    """
+    dataset = PatchDataset.from_slide_grid(filepath_list, level=level, patch_size=patch_size, stride=patch_size,
+                                            min_tissue_fraction=0)
+    indices = np.random.default_rng(seed).permutation(len(dataset))[:num_patches]
+    batches = [indices[i:i+batch_size] for i in range(0, len(indices), batch_size)]
+    print(f'{len(dataset)} patches of {patch_size}px at level {level} in {len(filepath_list)} slides, reading {len(indices)}')
+
+    results = {}
+    for num_workers in num_workers_list:
+        start = time.perf_counter()
+        if num_workers == 0:
+            for batch in batches:
+                dataset.get_batch(batch)
+        else:
+            with multiprocessing.Pool(num_workers, initializer=_init_dataset_worker, initargs=(dataset,)) as pool:
+                for _ in pool.imap_unordered(_read_dataset_batch, batches):
+                    pass
+        results[num_workers] = len(indices) / (time.perf_counter() - start)
+        print(f'\tworkers {num_workers:>3}: {results[num_workers]:.1f} patches/sec')
+    return results
+
+
+def make_synthetic_annotations(num_polygons, dimensions=(100000, 80000), max_radius=2000, num_vertices=64, seed=0):
+    rng = np.random.default_rng(seed)
+    annotations = []
+    for idx in range(num_polygons):
+        center = rng.uniform((0, 0), dimensions)
+        radius = rng.uniform(max_radius/20, max_radius)
+        angles = np.sort(rng.uniform(0, 2*np.pi, num_vertices))
+        radii = radius * rng.uniform(0.6, 1.0, num_vertices)
+        coordinates = np.maximum(np.stack([center[0]+radii*np.cos(angles), center[1]+radii*np.sin(angles)], axis=1), 0)
+        annotations.append({'name': f'Annotation {idx}',
+                            'type': 'Polygon',
+                            'label': int(rng.integers(0, 2)),
+                            'coordinates': coordinates,
+                            'bbox': ((coordinates[:, 0].min(), coordinates[:, 1].min()),
+                                        (coordinates[:, 0].max(), coordinates[:, 1].max()))})
+    return annotations
+
+
+def _linear_query(annotations, upper_left, lower_right):
+    return [idx for idx, annotation in enumerate(annotations)
+            if annotation['bbox'][0][0] <= lower_right[0] and annotation['bbox'][1][0] >= upper_left[0]
+                and annotation['bbox'][0][1] <= lower_right[1] and annotation['bbox'][1][1] >= upper_left[1]]
+
+
+def _linear_labels_at(annotations, points):
+    from matplotlib.path import Path
+    labels = np.full(len(points), -1, dtype=np.int8)
+    for annotation in annotations:
+        labels[Path(annotation['coordinates']).contains_points(points)] = annotation['label']
+    return labels
+
+
+def benchmark_annotation_index(num_polygons=5000, num_queries=2000, num_points=200000, query_size=1024,
+                                dimensions=(100000, 80000), seed=0):
+    annotations = make_synthetic_annotations(num_polygons, dimensions, seed=seed)
+    rng = np.random.default_rng(seed+1)
+    upper_lefts = rng.uniform((0, 0), (dimensions[0]-query_size, dimensions[1]-query_size), (num_queries, 2))
+    points = rng.uniform((0, 0), dimensions, (num_points, 2))
+
+    start = time.perf_counter()
+    index = AnnotationIndex(annotations)
+    build_time = time.perf_counter() - start
+    print(f'{num_polygons} polygons on {dimensions}, index built in {build_time:.3f}s')
+
+    start = time.perf_counter()
+    linear_results = [_linear_query(annotations, upper_left, upper_left+query_size) for upper_left in upper_lefts]
+    linear_query_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index_results = [index.query(upper_left, upper_left+query_size) for upper_left in upper_lefts]
+    index_query_time = time.perf_counter() - start
+    assert linear_results == index_results
+    print(f'\t{num_queries} region queries: linear {num_queries/linear_query_time:.0f}/s, '
+          f'indexed {num_queries/index_query_time:.0f}/s, {linear_query_time/index_query_time:.1f}x')
+
+    start = time.perf_counter()
+    linear_labels = _linear_labels_at(annotations, points)
+    linear_label_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index_labels = index.labels_at(points)
+    index_label_time = time.perf_counter() - start
+    assert (linear_labels == index_labels).all()
+    print(f'\t{num_points} point labels: linear {num_points/linear_label_time:.0f}/s, '
+          f'indexed {num_points/index_label_time:.0f}/s, {linear_label_time/index_label_time:.1f}x')
+    return {'build_time': build_time,
+            'linear_query_time': linear_query_time, 'index_query_time': index_query_time,
+            'linear_label_time': linear_label_time, 'index_label_time': index_label_time}
+
+
+HEAVY_MODULES = ['matplotlib', 'cv2', 'tifffile', 'torch']
+
+
+def _import_time(statement):
+    """
+    Cumulative import time in seconds of a statement in a fresh interpreter, from `python -X importtime`,
+    with the top-level modules it loaded.
+    """
+    import subprocess
+    import sys
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=package_parent,
+                                capture_output=True, text=True, check=True)
+    total, modules = 0, {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented under the module that triggered them
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+        modules.setdefault(name.strip().split('.')[0], 0)
+    return total / 1e6, set(modules)
+
+
+def benchmark_import_time(statements=('from data_utils.slide import Slide',
+                                        'from data_utils.annotation import Annotation',
+                                        'from data_utils.slide_converter import SlideConverter'), repeat=5):
+    results = {}
+    for statement in statements:
+        best, modules = min(_import_time(statement) for _ in range(repeat))
+        heavy = [module for module in HEAVY_MODULES if module in modules]
+        results[statement] = {'seconds': best, 'modules': len(modules), 'heavy_modules': heavy}
+        print(f'{statement}: {best*1000:.0f}ms, {len(modules)} top-level modules, heavy: {", ".join(heavy) or "none"}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    region_reader_parser = subparsers.add_parser('region_reader')
+    region_reader_parser.add_argument('--slide', default=None, help='slide path relative to ARGS_raw_dir, defaults to the first dataset item')
+    region_reader_parser.add_argument('--size', type=int, default=8192)
+    region_reader_parser.add_argument('--tile-size', type=int, default=1024)
+    region_reader_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    region_reader_parser.add_argument('--repeat', type=int, default=3)
+
+    tile_cache_parser = subparsers.add_parser('tile_cache')
+    tile_cache_parser.add_argument('--slide', default=None, help='slide path relative to ARGS_raw_dir, defaults to the first dataset item')
+    tile_cache_parser.add_argument('--patch-size', type=int, default=256)
+    tile_cache_parser.add_argument('--stride', type=int, default=128)
+    tile_cache_parser.add_argument('--size', type=int, default=8192)
+
+    patch_dataset_parser = subparsers.add_parser('patch_dataset')
+    patch_dataset_parser.add_argument('--slides', nargs='+', default=None, help='slide paths relative to ARGS_raw_dir, defaults to the first dataset item')
+    patch_dataset_parser.add_argument('--level', type=int, default=0)
+    patch_dataset_parser.add_argument('--patch-size', type=int, default=256)
+    patch_dataset_parser.add_argument('--patches', type=int, default=4096)
+    patch_dataset_parser.add_argument('--batch-size', type=int, default=64)
+    patch_dataset_parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+
+    annotation_index_parser = subparsers.add_parser('annotation_index')
+    annotation_index_parser.add_argument('--polygons', type=int, default=5000)
+    annotation_index_parser.add_argument('--queries', type=int, default=2000)
+    annotation_index_parser.add_argument('--points', type=int, default=200000)
+
+    import_time_parser = subparsers.add_parser('import_time')
+    import_time_parser.add_argument('--statements', nargs='+', default=None,
+                                    help='import statements to time, defaults to Slide, Annotation and SlideConverter')
+    import_time_parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.benchmark == 'region_reader':
+        slide_path = args.slide if args.slide is not None else utils.get_raw_item_path_with_index(0)
+        benchmark_region_reader(slide_path, args.size, args.tile_size, args.workers, args.repeat)
+    elif args.benchmark == 'tile_cache':
+        slide_path = args.slide if args.slide is not None else utils.get_raw_item_path_with_index(0)
+        benchmark_tile_cache(slide_path, args.patch_size, args.stride, args.size)
+    elif args.benchmark == 'patch_dataset':
+        slide_paths = args.slides if args.slides is not None else [utils.get_raw_item_path_with_index(0)]
+        benchmark_patch_dataset(slide_paths, args.level, args.patch_size, args.patches, args.batch_size, args.workers)
+    elif args.benchmark == 'annotation_index':
+        benchmark_annotation_index(args.polygons, args.queries, args.points)
+    elif args.benchmark == 'import_time':
+        if args.statements is not None:
+            benchmark_import_time(args.statements, args.repeat)
+        else:
+            benchmark_import_time(repeat=args.repeat)
@@ -0,0 +1,294 @@
+"""
+Reproducible benchmarks on a synthetic dataset: pyramidal TIFF slides readable by OpenSlide plus
+matching ASAP annotation XMLs, generated once under --dataset-dir.
+
+Every case runs in a freshly spawned process pointed at the synthetic dataset through
+HISTOPATH_DATASET_DIR, so that its peak RSS is its own. Results are appended as JSON lines
+to --results together with the git commit, to compare runs across commits:
+
+    python -m data_utils.benchmark_suite --dataset-dir /tmp/histopath_benchmark --slides 2
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from os.path import join as pjoin
+from xml.etree import ElementTree
+
+import numpy as np
+
+DATASET_NAME = 'synthetic'
+BACKGROUND_COLOR = (240, 238, 242)
+TISSUE_COLOR = (214, 140, 180)
+
+
+def _tissue_blobs(dimensions, num_blobs, seed):
+    rng = np.random.default_rng(seed)
+    min_side = min(dimensions)
+    centers = rng.uniform((0, 0), dimensions, (num_blobs, 2))
+    radii = rng.uniform(min_side/20, min_side/6, num_blobs)
+    return centers, radii
+
+
+def _synthetic_tile(blobs, level_downsample, tile_x, tile_y, tile_size, seed):
+    """
+    One tile_size x tile_size RGB tile of a level: tissue where the pixel center falls in a blob, with noise.
+    """
+    centers, radii = blobs
+    xs = (np.arange(tile_x, tile_x+tile_size) + 0.5) * level_downsample
+    ys = (np.arange(tile_y, tile_y+tile_size) + 0.5) * level_downsample
+    tissue = np.zeros((tile_size, tile_size), dtype=bool)
+    for (center_x, center_y), radius in zip(centers, radii):
+        if xs[0] > center_x+radius or xs[-1] < center_x-radius or ys[0] > center_y+radius or ys[-1] < center_y-radius:
+            continue
+        tissue |= ((xs[None, :]-center_x)**2 + (ys[:, None]-center_y)**2) <= radius**2
+    noise = np.random.default_rng((seed, tile_x, tile_y, round(level_downsample))).integers(-12, 13, (tile_size, tile_size, 3))
+    tile = np.where(tissue[:, :, None], TISSUE_COLOR, BACKGROUND_COLOR) + noise
+    return np.clip(tile, 0, 255).astype(np.uint8)
+
+
+def make_synthetic_slide(filepath, dimensions, tile_size=256, level_factor=4, num_blobs=12, compression='jpeg', seed=0):
+    """
+    Tiled pyramidal TIFF with levels downsampled by level_factor down to one tile, rendered tile by tile
+    so that memory stays flat whatever the dimensions. Same page layout as tiled_tiff.save_tiled_tiff.
+    """
+    from .tiled_tiff import _import_tifffile
+    from .utils import atomic_path
+    tifffile = _import_tifffile()
+    blobs = _tissue_blobs(dimensions, num_blobs, seed)
+    with atomic_path(filepath) as tmp_path, \
+            tifffile.TiffWriter(tmp_path, bigtiff=dimensions[0]*dimensions[1]*3 >= 2**32 - 2**25) as tif:
+        level_downsample = 1
+        while True:
+            level_width, level_height = math.ceil(dimensions[0]/level_downsample), math.ceil(dimensions[1]/level_downsample)
+            tiles = (_synthetic_tile(blobs, level_downsample, x, y, tile_size, seed)
+                        for y in range(0, level_height, tile_size) for x in range(0, level_width, tile_size))
+            tif.write(tiles, shape=(level_height, level_width, 3), dtype=np.uint8,
+                        tile=(tile_size, tile_size), photometric='rgb', compression=compression,
+                        subfiletype=0 if level_downsample == 1 else 1)
+            if max(level_width, level_height) <= tile_size:
+                break
+            level_downsample *= level_factor
+
+
+def make_synthetic_annotation_xml(filepath, dimensions, num_polygons, num_vertices=64, seed=0):
+    """
+    ASAP annotation XML with num_polygons random polygons, one in ten written as a Rectangle.
+    """
+    from .benchmark import make_synthetic_annotations
+    annotations = make_synthetic_annotations(num_polygons, dimensions, max_radius=min(dimensions)/40,
+                                                num_vertices=num_vertices, seed=seed)
+    root = ElementTree.Element('ASAP_Annotations')
+    annotations_element = ElementTree.SubElement(root, 'Annotations')
+    for idx, annotation in enumerate(annotations):
+        if idx % 10 == 9:
+            (x0, y0), (x1, y1) = annotation['bbox']
+            annotation_type, coordinates = 'Rectangle', [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        else:
+            annotation_type, coordinates = 'Polygon', annotation['coordinates']
+        annotation_element = ElementTree.SubElement(annotations_element, 'Annotation', Name=annotation['name'],
+                                                    Type=annotation_type, PartOfGroup=['negative', 'positive'][annotation['label']],
+                                                    Color='#F4FA58')
+        coordinates_element = ElementTree.SubElement(annotation_element, 'Coordinates')
+        for order, (x, y) in enumerate(coordinates):
+            ElementTree.SubElement(coordinates_element, 'Coordinate', Order=str(order), X=f'{x:.4f}', Y=f'{y:.4f}')
+    groups_element = ElementTree.SubElement(root, 'AnnotationGroups')
+    for name, color in [('negative', '#64FE2E'), ('positive', '#FF0000')]:
+        group_element = ElementTree.SubElement(groups_element, 'Group', Name=name, PartOfGroup='None', Color=color)
+        ElementTree.SubElement(group_element, 'Attributes')
+    ElementTree.ElementTree(root).write(filepath, encoding='utf-8', xml_declaration=True)
+
+
+def make_synthetic_dataset(dataset_dir, num_slides, dimensions, num_polygons, num_vertices=64, force=False):
+    """
+    Slides and annotations under dataset_dir in the layout of data_config.py. Existing files are kept
+    unless force is set, generating is deterministic for given parameters.
+    """
+    raw_dir = pjoin(dataset_dir, 'raw', DATASET_NAME)
+    annotation_dir = pjoin(dataset_dir, 'annotation', DATASET_NAME)
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(annotation_dir, exist_ok=True)
+    spec_path = pjoin(dataset_dir, 'synthetic_spec.json')
+    spec = {'num_slides': num_slides, 'dimensions': list(dimensions), 'num_polygons': num_polygons, 'num_vertices': num_vertices}
+    if not force and os.path.exists(spec_path):
+        with open(spec_path) as f:
+            force = json.load(f) != spec
+
+    for idx in range(num_slides):
+        slide_path = pjoin(raw_dir, f'synthetic_{idx:03d}.tiff')
+        annotation_path = pjoin(annotation_dir, f'synthetic_{idx:03d}.xml')
+        if force or not os.path.exists(slide_path):
+            start = time.perf_counter()
+            make_synthetic_slide(slide_path, dimensions, seed=idx)
+            print(f'{slide_path} generated in {time.perf_counter() - start:.1f}s')
+        if force or not os.path.exists(annotation_path):
+            make_synthetic_annotation_xml(annotation_path, dimensions, num_polygons, num_vertices, seed=idx)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    return spec
+
+
+def _peak_rss():
+    import resource
+    # ru_maxrss is in kilobytes on Linux; children covers the pools started by a case
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def _timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def case_pil_image(scale_factor):
+    from . import utils
+    from .slide import Slide
+    items = utils.get_dataset_item_list()
+    seconds = sum(_timed(lambda: Slide(item).pil_image(scale_factor)) for item in items)
+    pixels = sum(Slide(item).dimensions[0] * Slide(item).dimensions[1] for item in items)
+    return {'seconds': seconds, 'throughput': pixels / 1e6 / seconds, 'unit': 'level-0 Mpixels/s'}
+
+
+def case_fullsize_region(raw_size=4096, num_workers=1):
+    from . import utils
+    from .slide import Slide
+    slide = Slide(utils.get_raw_item_path_with_index(0))
+    raw_size = (min(raw_size, slide.dimensions[0]), min(raw_size, slide.dimensions[1]))
+    location = ((slide.dimensions[0]-raw_size[0])//2, (slide.dimensions[1]-raw_size[1])//2)
+    seconds = _timed(lambda: slide.get_fullsize_region_by_tile(location, raw_size, num_workers=num_workers))
+    return {'seconds': seconds, 'throughput': raw_size[0] * raw_size[1] / 1e6 / seconds, 'unit': 'Mpixels/s'}
+
+
+def case_annotation_parse():
+    from . import utils
+    from .annotation import Annotation
+    items = utils.get_dataset_item_list(annotated=True)
+    vertices = 0
+    start = time.perf_counter()
+    for item in items:
+        vertices += len(utils.parse_annotation(utils.get_annotation_fullpath(item))['coordinates'])
+    seconds = time.perf_counter() - start
+    # Annotation() itself goes through the parsed-annotation cache
+    cached_seconds = sum(_timed(lambda: Annotation(item)) for item in items)
+    return {'seconds': seconds, 'throughput': vertices / seconds, 'unit': 'vertices/s', 'annotation_seconds': cached_seconds}
+
+
+def case_mask_image(scale_factor):
+    from . import utils
+    from .annotation import Annotation
+    annotations = [Annotation(item) for item in utils.get_dataset_item_list(annotated=True)]
+    seconds = sum(_timed(lambda: annotation.get_mask_image(scale_factor)) for annotation in annotations)
+    return {'seconds': seconds, 'throughput': len(annotations) / seconds, 'unit': 'masks/s'}
+
+
+def case_mask_tile(tile_size=1024, num_tiles=200, seed=0):
+    from . import utils
+    from .annotation import Annotation
+    annotation = Annotation(utils.get_dataset_item_list(annotated=True)[0])
+    width, height = annotation.slide.dimensions
+    rng = np.random.default_rng(seed)
+    # get_mask_tile positions are (row, column), but are checked against (width, height)
+    side = min(width, height) - tile_size
+    positions = rng.integers(0, side, (num_tiles, 2))
+    seconds = _timed(lambda: [annotation.get_mask_tile(tuple(position), tile_size) for position in positions])
+    return {'seconds': seconds, 'throughput': num_tiles / seconds, 'unit': 'tiles/s'}
+
+
+def case_convert(scale_factors, num_thread=1):
+    from . import utils
+    from .slide_converter import SlideConverter
+    items = utils.get_dataset_item_list()
+    converter = SlideConverter(items, scale_factors, force_reconvert=True)
+    seconds = _timed(lambda: converter.multithread_convert(num_thread))
+    return {'seconds': seconds, 'throughput': len(items) / seconds, 'unit': 'slides/s'}
+
+
+def case_stats(scale_factor, num_thread=1):
+    from . import utils
+    from . import slide_converter
+    from .data_config import ARGS_stat_dir
+    # drop the cached stats table so that every item is collected again
+    table_path = pjoin(ARGS_stat_dir, f'{scale_factor}X_file_stats.csv')
+    if os.path.exists(table_path):
+        os.remove(table_path)
+    items = utils.get_dataset_item_list()
+    seconds = _timed(lambda: slide_converter.get_stats(scale_factor, num_thread))
+    return {'seconds': seconds, 'throughput': len(items) / seconds, 'unit': 'slides/s'}
+
+
+# run in this order, stats reads the images written by convert
+CASES = {'pil_image': (case_pil_image, {'scale_factor': 16}),
+            'pil_image_resized': (case_pil_image, {'scale_factor': 10}),
+            'fullsize_region': (case_fullsize_region, {'raw_size': 4096}),
+            'annotation_parse': (case_annotation_parse, {}),
+            'mask_image': (case_mask_image, {'scale_factor': 16}),
+            'mask_tile': (case_mask_tile, {'tile_size': 1024}),
+            'convert': (case_convert, {'scale_factors': [16]}),
+            'convert_multiscale': (case_convert, {'scale_factors': [4, 8, 16, 64]}),
+            'stats': (case_stats, {'scale_factor': 16})}
+
+
+def _run_case(name):
+    function, params = CASES[name]
+    result = function(**params)
+    result['peak_rss'], result['peak_rss_children'] = _peak_rss()
+    return result
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(dataset_dir, case_names, results_path, repeat=1):
+    os.environ['HISTOPATH_DATASET_DIR'] = dataset_dir
+    os.environ['HISTOPATH_DATASET'] = DATASET_NAME
+    with open(pjoin(dataset_dir, 'synthetic_spec.json')) as f:
+        spec = json.load(f)
+    commit = get_git_commit()
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in case_names:
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_case, name).result()
+            result.update({'case': name, 'params': CASES[name][1], 'dataset': spec, 'commit': commit,
+                            'time': datetime.datetime.now().isoformat(timespec='seconds')})
+            results.append(result)
+            print(f"{name:>20}: {result['seconds']:.3f}s, {result['throughput']:.2f} {result['unit']}, "
+                    f"peak RSS {result['peak_rss'] / 1024**2:.0f}MB")
+
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    print(f'{len(results)} results appended to {results_path}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-dir', default=pjoin('/tmp', 'histopath_benchmark'))
+    parser.add_argument('--results', default=None, help='JSON lines results file, defaults to <dataset-dir>/results.jsonl')
+    parser.add_argument('--slides', type=int, default=2)
+    parser.add_argument('--width', type=int, default=20000)
+    parser.add_argument('--height', type=int, default=15000)
+    parser.add_argument('--polygons', type=int, default=500)
+    parser.add_argument('--vertices', type=int, default=64)
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true')
+    args = parser.parse_args()
+
+    make_synthetic_dataset(args.dataset_dir, args.slides, (args.width, args.height), args.polygons, args.vertices,
+                            force=args.regenerate)
+    run_suite(args.dataset_dir, args.cases, args.results or pjoin(args.dataset_dir, 'results.jsonl'), args.repeat)
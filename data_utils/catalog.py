@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import hashlib
+
+from .data_config import *
+
+SCHEMA_VERSION = 2
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.vms', '.vmu', '.scn', '.mrxs', '.svslide', '.bif')
+
+
+class DatasetCatalog:
+    """
+    SQLite index of the slides under a raw dataset directory, with their size, mtime and whether
+    an ASAP annotation exists for them.
+
+    refresh() only lists directories, of both the raw and the annotation tree, whose mtime changed since
+    the last refresh; unchanged ones are skipped, apart from stat-ing them, which keeps startup cheap on
+    network file systems. A file rewritten in place does not change its directory mtime, use
+    refresh(full=True) to pick that up.
+    """
+
+    def __init__(self, root=ARGS_raw_dir, annotation_root=ARGS_annotation_dir, db_path=None, refresh=True):
+        self.root = root
+        self.annotation_root = annotation_root
+        if db_path is None:
+            key = hashlib.md5(os.path.abspath(root).encode('utf-8')).hexdigest()
+            db_path = pjoin(ARGS_cache_dir, 'catalog', f'{key}.sqlite')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=60)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            # the catalog is only a cache, an outdated one is rebuilt from scratch
+            with self.db:
+                self.db.executescript(f'''
+                    DROP TABLE IF EXISTS items;
+                    DROP TABLE IF EXISTS dirs;
+                    DROP TABLE IF EXISTS annotations;
+                    PRAGMA user_version = {SCHEMA_VERSION};
+                ''')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS items (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL,
+                                                has_annotation INTEGER DEFAULT 0, position INTEGER);
+            CREATE TABLE IF NOT EXISTS annotations (path TEXT PRIMARY KEY, dir TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (tree TEXT, path TEXT, parent TEXT, mtime REAL, PRIMARY KEY (tree, path));
+            CREATE INDEX IF NOT EXISTS items_position ON items (position);
+            CREATE INDEX IF NOT EXISTS items_dir ON items (dir);
+            CREATE INDEX IF NOT EXISTS items_size ON items (size);
+            CREATE INDEX IF NOT EXISTS items_annotation ON items (has_annotation, size);
+            CREATE INDEX IF NOT EXISTS annotations_dir ON annotations (dir);
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (tree, parent);
+        ''')
+        if refresh:
+            self.refresh()
+
+    def _scan_dir(self, tree, folder, full, changed_dirs):
+        """
+        Sync the listing of `folder` in the raw or the annotation tree and recurse into its subdirectories,
+        adding every directory whose content changed to changed_dirs.
+        """
+        root = self.root if tree == 'raw' else self.annotation_root
+        fullpath = pjoin(root, folder) if folder else root
+        try:
+            mtime = os.stat(fullpath).st_mtime
+        except FileNotFoundError:
+            self._remove_dir(tree, folder, changed_dirs)
+            return
+        row = self.db.execute('SELECT mtime FROM dirs WHERE tree = ? AND path = ?', (tree, folder)).fetchone()
+        if full or row is None or row[0] != mtime:
+            changed_dirs.add(folder)
+            files, subdirs = {}, []
+            with os.scandir(fullpath) as entries:
+                for entry in entries:
+                    path = pjoin(folder, entry.name) if folder else entry.name
+                    if entry.is_dir():
+                        subdirs.append(path)
+                    elif tree == 'raw' and entry.name.lower().endswith(SLIDE_EXTENSIONS):
+                        stat = entry.stat()
+                        files[path] = (stat.st_size, stat.st_mtime)
+                    elif tree == 'annotation' and entry.name.endswith('.xml'):
+                        # annotations are stored by the slide path they belong to, without extension
+                        files[os.path.splitext(path)[0]] = None
+
+            if tree == 'raw':
+                known_files = {path for path, in self.db.execute('SELECT path FROM items WHERE dir = ?', (folder,))}
+                self.db.executemany('DELETE FROM items WHERE path = ?', [(path,) for path in known_files - set(files)])
+                self.db.executemany('INSERT INTO items (path, dir, size, mtime) VALUES (?, ?, ?, ?) '
+                                    'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime',
+                                    [(path, folder, size, file_mtime) for path, (size, file_mtime) in files.items()])
+            else:
+                self.db.execute('DELETE FROM annotations WHERE dir = ?', (folder,))
+                self.db.executemany('INSERT INTO annotations (path, dir) VALUES (?, ?)',
+                                    [(path, folder) for path in files])
+            known_subdirs = {path for path, in self.db.execute('SELECT path FROM dirs WHERE tree = ? AND parent = ?',
+                                                                (tree, folder))}
+            for path in known_subdirs - set(subdirs):
+                self._remove_dir(tree, path, changed_dirs)
+            for path in subdirs:
+                if path not in known_subdirs:
+                    self.db.execute('INSERT INTO dirs (tree, path, parent, mtime) VALUES (?, ?, ?, NULL)',
+                                    (tree, path, folder))
+            self.db.execute('INSERT INTO dirs (tree, path, parent, mtime) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT(tree, path) DO UPDATE SET mtime = excluded.mtime', (tree, folder, None, mtime))
+
+        for path, in self.db.execute('SELECT path FROM dirs WHERE tree = ? AND parent = ?', (tree, folder)).fetchall():
+            self._scan_dir(tree, path, full, changed_dirs)
+
+    def _remove_dir(self, tree, folder, changed_dirs):
+        for path, in self.db.execute('SELECT path FROM dirs WHERE tree = ? AND parent = ?', (tree, folder)).fetchall():
+            self._remove_dir(tree, path, changed_dirs)
+        if tree == 'raw':
+            self.db.execute('DELETE FROM items WHERE dir = ?', (folder,))
+        else:
+            self.db.execute('DELETE FROM annotations WHERE dir = ?', (folder,))
+        self.db.execute('DELETE FROM dirs WHERE tree = ? AND path = ?', (tree, folder))
+        changed_dirs.add(folder)
+
+    def _update_annotation_flags(self, folder):
+        annotations = {path for path, in self.db.execute('SELECT path FROM annotations WHERE dir = ?', (folder,))}
+        rows = self.db.execute('SELECT path, has_annotation FROM items WHERE dir = ?', (folder,)).fetchall()
+        self.db.executemany('UPDATE items SET has_annotation = ? WHERE path = ?',
+                            [(int(not has_annotation), path) for path, has_annotation in rows
+                                if (os.path.splitext(path)[0] in annotations) != bool(has_annotation)])
+
+    def refresh(self, full=False):
+        with self.db:
+            changed_raw_dirs, changed_annotation_dirs = set(), set()
+            self._scan_dir('raw', '', full, changed_raw_dirs)
+            self._scan_dir('annotation', '', full, changed_annotation_dirs)
+            if changed_raw_dirs:
+                # positions follow the path order, so that index lookups are a single indexed query
+                paths = [path for path, in self.db.execute('SELECT path FROM items ORDER BY path')]
+                self.db.executemany('UPDATE items SET position = ? WHERE path = ?', enumerate(paths))
+            # the annotation tree mirrors the raw one, so only items of changed directories can change flag
+            for folder in changed_raw_dirs | changed_annotation_dirs:
+                self._update_annotation_flags(folder)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        row = self.db.execute('SELECT path FROM items WHERE position = ?', (index,)).fetchone()
+        if row is None:
+            raise IndexError(f'catalog index {index} out of range')
+        return row[0]
+
+    def _query(self, columns, annotated=None, min_size=None, max_size=None):
+        conditions, parameters = [], []
+        if annotated is not None:
+            conditions.append('has_annotation = ?')
+            parameters.append(int(annotated))
+        if min_size is not None:
+            conditions.append('size >= ?')
+            parameters.append(min_size)
+        if max_size is not None:
+            conditions.append('size <= ?')
+            parameters.append(max_size)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        return self.db.execute(f'SELECT {columns} FROM items{where} ORDER BY position', parameters)
+
+    def items(self, annotated=None, min_size=None, max_size=None):
+        """
+        Slide paths relative to root, optionally only the (un)annotated ones or within a byte size range.
+        """
+        return [path for path, in self._query('path', annotated, min_size, max_size)]
+
+    def records(self, annotated=None, min_size=None, max_size=None):
+        return [{'path': path, 'size': size, 'mtime': mtime, 'has_annotation': bool(has_annotation)}
+                for path, size, mtime, has_annotation in self._query('path, size, mtime, has_annotation',
+                                                                        annotated, min_size, max_size)]
+
+    def close(self):
+        self.db.close()
@@ -2,11 +2,40 @@ import os
 from os.path import join as pjoin
 
 ARGS_scale_factor = 16
+# 'png' for one image per slide, 'tiff' for a tiled pyramidal TIFF (needs tifffile, and imagecodecs for jpeg tiles)
 ARGS_convert_image_format = 'png'
+ARGS_convert_tile_size = 256
+ARGS_convert_tiff_compression = 'jpeg'
+# bytes of memory the slides being converted at once may hold, None for half of the physical memory
+ARGS_convert_memory_budget = None
 
-ARGS_dataset_dir = r'/home/LAB/yujinze/workspace/histopath/data'
-ARGS_dataset_chosen = 'LN20210301_201slides'
+# decoded tile cache shared by region reads, see tile_cache.py
+ARGS_tile_cache_bytes = 512 * 1024**2
+ARGS_tile_cache_tile_size = 512
+
+ARGS_patch_level = 0
+ARGS_patch_size = 256
+ARGS_patch_stride = 256
+ARGS_patch_min_tissue_fraction = 0.5
+ARGS_patch_image_format = 'png'
+# downsample of the label mask the per-patch label fractions are computed from
+ARGS_patch_label_scale_factor = 16
+ARGS_patches_per_shard = 4096
+
+# longest side of the annotation overlay thumbnails used for QA review
+ARGS_overlay_max_size = 2048
+
+# per-stage timers and counters of metrics.py, off unless HISTOPATH_METRICS=1
+ARGS_metrics = os.environ.get('HISTOPATH_METRICS', '0') not in ['', '0']
+
+# HISTOPATH_DATASET_DIR/HISTOPATH_DATASET point everything at another dataset, e.g. the synthetic one of benchmark_suite.py
+ARGS_dataset_dir = os.environ.get('HISTOPATH_DATASET_DIR', r'/home/LAB/yujinze/workspace/histopath/data')
+ARGS_dataset_chosen = os.environ.get('HISTOPATH_DATASET', 'LN20210301_201slides')
 ARGS_raw_dir = pjoin(ARGS_dataset_dir, 'raw', ARGS_dataset_chosen)
 ARGS_converted_dir = pjoin(ARGS_dataset_dir, 'preprocessed', ARGS_dataset_chosen, f'{ARGS_scale_factor}X')
 ARGS_stat_dir = pjoin(ARGS_dataset_dir, 'stats', ARGS_dataset_chosen)
 ARGS_annotation_dir = pjoin(ARGS_dataset_dir, 'annotation', ARGS_dataset_chosen)
+ARGS_cache_dir = pjoin(ARGS_dataset_dir, 'cache', ARGS_dataset_chosen)
+ARGS_patch_dir = pjoin(ARGS_dataset_dir, 'patches', ARGS_dataset_chosen, f'level{ARGS_patch_level}_{ARGS_patch_size}px')
+ARGS_overlay_dir = pjoin(ARGS_dataset_dir, 'overlays', ARGS_dataset_chosen, f'{ARGS_overlay_max_size}px')
+ARGS_metrics_path = pjoin(ARGS_stat_dir, 'metrics.jsonl')
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+from .data_config import *
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then left out
+    resource = None
+
+_enabled = ARGS_metrics
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_NULL_TIMER = nullcontext()
+
+
+def enable(enabled=True):
+    """
+    Turn collection on or off in this process. Pool workers forked afterwards inherit the setting.
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Timer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            seconds, calls = _timers.get(self.stage, (0.0, 0))
+            _timers[self.stage] = (seconds + elapsed, calls + 1)
+        return False
+
+
+def timer(stage):
+    """
+    Context manager adding the wall time of its block to `stage`. A shared no-op when disabled.
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def reset():
+    """
+    Clear the timers and counters, and on Linux also the peak RSS, so the next snapshot() covers one slide.
+    """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+    if _enabled:
+        _reset_peak_rss()
+
+
+def get_peak_rss():
+    """
+    Peak RSS in bytes since the last reset() where the kernel allows resetting it, else since process start.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # reported in kB
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def snapshot(slide_path, **extra):
+    """
+    Record of what was collected since the last reset(), or None when disabled. peak_rss is the peak since
+    that reset on Linux; elsewhere it is the peak of the whole process, which in a reused pool worker can
+    come from an earlier, larger slide.
+    """
+    if not _enabled:
+        return None
+    with _lock:
+        record = {'slide': slide_path,
+                    'pid': os.getpid(),
+                    'timers': {stage: {'seconds': seconds, 'calls': calls} for stage, (seconds, calls) in _timers.items()},
+                    'counters': dict(_counters),
+                    'peak_rss': get_peak_rss()}
+    record.update(extra)
+    return record
+
+
+def write_records(records, filepath=ARGS_metrics_path):
+    """
+    Append the per-slide records to a JSON lines file.
+    """
+    records = [record for record in records if record is not None]
+    if not records:
+        return
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def aggregate(records):
+    timers, counters = {}, {}
+    peak_rss = 0
+    records = [record for record in records if record is not None]
+    for record in records:
+        for stage, timing in record['timers'].items():
+            seconds, calls = timers.get(stage, (0.0, 0))
+            timers[stage] = (seconds + timing['seconds'], calls + timing['calls'])
+        for name, value in record['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        peak_rss = max(peak_rss, record['peak_rss'] or 0)
+    return {'slides': len(records),
+            'timers': {stage: {'seconds': seconds, 'calls': calls} for stage, (seconds, calls) in timers.items()},
+            'counters': counters,
+            'peak_rss': peak_rss}
+
+
+def print_summary(records, title='Metrics'):
+    summary = aggregate(records)
+    if summary['slides'] == 0:
+        return summary
+    total_seconds = sum(timing['seconds'] for timing in summary['timers'].values())
+    print(f"{title} of {summary['slides']} slides, peak RSS {summary['peak_rss'] / 1024**2:.0f}MB")
+    for stage, timing in sorted(summary['timers'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        print(f"\t{stage}: {timing['seconds']:.2f}s in {timing['calls']} calls "
+              f"({timing['seconds'] / total_seconds * 100 if total_seconds else 0:.1f}%)")
+    for name, value in sorted(summary['counters'].items()):
+        print(f"\t{name}: {value}")
+    return summary
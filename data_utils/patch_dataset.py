@@ -0,0 +1,96 @@
+import os
+import numpy as np
+
+from .data_config import *
+from . import utils
+
+try:
+    from torch.utils.data import Dataset
+except ImportError:
+    # works as a plain map-style dataset on machines without PyTorch
+    Dataset = object
+
+
+class PatchDataset(Dataset):
+    """
+    Map-style dataset of (slide, level, x, y) patches, x and y being level-0 upper-left corners.
+
+    OpenSlide handles are opened lazily and owned by the process that opened them: after a fork
+    (e.g. into DataLoader workers) every worker opens its own. Coordinates are kept in NumPy arrays
+    rather than lists of tuples so that forked workers do not copy them page by page.
+    """
+
+    def __init__(self, coordinates, patch_size, labels=None):
+        slide_paths = sorted({coordinate[0] for coordinate in coordinates})
+        slide_indices = {slide_path: idx for idx, slide_path in enumerate(slide_paths)}
+        self.slide_paths = slide_paths
+        self.slide_indices = np.array([slide_indices[coordinate[0]] for coordinate in coordinates], dtype=np.int32)
+        self.levels = np.array([coordinate[1] for coordinate in coordinates], dtype=np.int32)
+        self.positions = np.array([coordinate[2:4] for coordinate in coordinates], dtype=np.int64).reshape(-1, 2)
+        self.patch_size = (patch_size, patch_size) if isinstance(patch_size, int) else tuple(patch_size)
+        self.labels = np.asarray(labels) if labels is not None else None
+        self._handles = {}
+        self._pid = None
+
+    @classmethod
+    def from_slide_grid(cls, filepath_list, level=ARGS_patch_level, patch_size=ARGS_patch_size, stride=ARGS_patch_stride,
+                        min_tissue_fraction=ARGS_patch_min_tissue_fraction):
+        """
+        Dataset over the tissue-covered grid patches of the slides, as enumerated by PatchExtractor.
+        """
+        from .slide import Slide
+        from .patch_extractor import PatchExtractor
+        extractor = PatchExtractor(filepath_list, level=level, patch_size=patch_size, stride=stride,
+                                    min_tissue_fraction=min_tissue_fraction)
+        coordinates = []
+        for filepath in filepath_list:
+            upper_lefts, _ = extractor.get_patch_positions(Slide(filepath))
+            coordinates.extend((filepath, level, int(x), int(y)) for x, y in upper_lefts)
+        return cls(coordinates, patch_size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        state['_pid'] = None
+        return state
+
+    def __len__(self):
+        return len(self.slide_indices)
+
+    def _get_handle(self, slide_index):
+        if self._pid != os.getpid():
+            # inherited handles belong to the parent process
+            self._handles = {}
+            self._pid = os.getpid()
+        if slide_index not in self._handles:
+            self._handles[slide_index] = utils.open_slide(self.slide_paths[slide_index])
+        return self._handles[slide_index]
+
+    def get_coordinate(self, idx):
+        return (self.slide_paths[self.slide_indices[idx]], int(self.levels[idx]),
+                int(self.positions[idx, 0]), int(self.positions[idx, 1]))
+
+    def read_patch(self, idx, out=None):
+        return utils.read_region_array(self._get_handle(self.slide_indices[idx]),
+                                        self.positions[idx], self.levels[idx], self.patch_size, out=out)
+
+    def __getitem__(self, idx):
+        patch = self.read_patch(idx)
+        if self.labels is None:
+            return patch
+        return patch, self.labels[idx]
+
+    def get_batch(self, indices):
+        """
+        (N, H, W, 3) array of the patches at `indices`, read slide by slide so each handle is used in one run.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = np.empty((len(indices), self.patch_size[1], self.patch_size[0], 3), dtype=np.uint8)
+        for position in np.argsort(self.slide_indices[indices], kind='stable'):
+            self.read_patch(indices[position], out=batch[position])
+        return batch
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
@@ -0,0 +1,234 @@
+import multiprocessing
+import io
+import json
+import tarfile
+import time
+from contextlib import ExitStack
+import numpy as np
+import os
+from os.path import join as pjoin
+
+from .data_config import *
+from .slide import Slide
+from .annotation import Annotation
+from . import utils
+
+
+def get_patch_dir(level, patch_size, stride):
+    """
+    Default output dir of a patch grid, next to ARGS_patch_dir. The stride is only part of the name when
+    patches overlap or leave gaps, so the default grid keeps the name of ARGS_patch_dir.
+    """
+    name = f'level{level}_{patch_size}px' if stride == patch_size else f'level{level}_{patch_size}px_stride{stride}'
+    return pjoin(os.path.dirname(ARGS_patch_dir), name)
+
+
+def get_tissue_mask(image_array):
+    """
+    Tissue mask of a low-resolution RGB image: Otsu threshold on the HSV saturation channel.
+    """
+    import cv2
+    saturation = cv2.cvtColor(np.ascontiguousarray(image_array), cv2.COLOR_RGB2HSV)[:, :, 1]
+    _, mask = cv2.threshold(saturation, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return mask.astype(bool)
+
+
+def get_slide_tissue_mask(slide):
+    if 'thumbnail' in slide.metadata['associated_images']:
+        image = slide.thumbnail
+    else:
+        level = slide.level_count - 1
+        image = slide.get_tile((0, 0), slide.level_dimensions[level], level)
+    return get_tissue_mask(np.asarray(image))
+
+
+class ShardWriter:
+    """
+    WebDataset-style tar shards: every patch is stored as `<key>.<image_format>` plus `<key>.json`.
+    Shards are written under a temporary name and renamed once complete.
+    """
+
+    def __init__(self, pattern, max_count=ARGS_patches_per_shard):
+        self.pattern = pattern
+        self.max_count = max_count
+        self.shards = []
+        self.tar = None
+        self.count = 0
+
+    def _open(self):
+        self.path = self.pattern % len(self.shards)
+        self._pending = ExitStack()
+        self.tar = tarfile.open(self._pending.enter_context(utils.atomic_path(self.path)), 'w')
+        self.count = 0
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key, image_bytes, image_format, metadata):
+        if self.tar is None:
+            self._open()
+        self._add(f'{key}.{image_format}', image_bytes)
+        self._add(f'{key}.json', json.dumps(metadata).encode('utf-8'))
+        self.count += 1
+        if self.count >= self.max_count:
+            self.close()
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            # renames the temporary file to self.path
+            self._pending.close()
+            self.shards.append(self.path)
+            self.tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        elif self.tar is not None:
+            # drops the temporary file of the incomplete shard
+            self.tar.close()
+            self._pending.__exit__(*exc_info)
+            self.tar = None
+        return False
+
+
+class PatchExtractor:
+    def __init__(self, filepath_list, level=ARGS_patch_level, patch_size=ARGS_patch_size, stride=ARGS_patch_stride,
+                    min_tissue_fraction=ARGS_patch_min_tissue_fraction, image_format=ARGS_patch_image_format,
+                    label_scale_factor=ARGS_patch_label_scale_factor, output_dir=None):
+        self.filepath_list = filepath_list
+        self.level = level
+        self.patch_size = patch_size
+        self.stride = stride
+        self.min_tissue_fraction = min_tissue_fraction
+        self.image_format = image_format
+        self.label_scale_factor = label_scale_factor
+        self.output_dir = output_dir if output_dir is not None else get_patch_dir(level, patch_size, stride)
+
+    def get_patch_positions(self, slide):
+        """
+        Level-0 upper-left corners of the grid patches at self.level, with their tissue fractions,
+        keeping only the ones covered by at least min_tissue_fraction tissue.
+        """
+        downsample = slide.metadata['level_downsamples'][self.level]
+        upper_lefts = utils.get_grid_positions(slide.level_dimensions[self.level], downsample, self.patch_size, self.stride)
+
+        tissue_mask = get_slide_tissue_mask(slide)
+        mask_scale = (slide.dimensions[0] / tissue_mask.shape[1], slide.dimensions[1] / tissue_mask.shape[0])
+        tissue_fractions = utils.get_window_fractions(tissue_mask, mask_scale, upper_lefts, (self.patch_size*downsample,)*2)
+        keep = tissue_fractions >= self.min_tissue_fraction
+        return upper_lefts[keep], tissue_fractions[keep]
+
+    def _done_path(self, filepath):
+        return pjoin(self.output_dir, os.path.splitext(filepath)[0] + '.json')
+
+    def _load_summary(self, filepath):
+        """
+        Summary of an earlier extraction of the slide into output_dir, None when there is none.
+        """
+        try:
+            with open(self._done_path(filepath)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_current(self, summary):
+        return summary is not None and \
+                (summary.get('level'), summary.get('patch_size'), summary.get('stride')) == (self.level, self.patch_size, self.stride)
+
+    def extract_slide(self, filepath, force_reextract=False):
+        done_path = self._done_path(filepath)
+        previous_summary = self._load_summary(filepath)
+        if self._is_current(previous_summary) and not force_reextract:
+            print(f'Patches of {filepath} already extracted, skipped.')
+            return previous_summary
+
+        if os.path.exists(utils.get_annotation_fullpath(filepath)):
+            annotation = Annotation(filepath)
+            slide = annotation.slide
+        else:
+            annotation = None
+            slide = Slide(filepath)
+
+        upper_lefts, tissue_fractions = self.get_patch_positions(slide)
+        downsample = slide.metadata['level_downsamples'][self.level]
+        if annotation is not None:
+            # background/negative/positive area fractions, the patch label is the largest one (-1 for background)
+            label_fractions = annotation.get_window_label_fractions(upper_lefts, (self.patch_size*downsample,)*2,
+                                                                    self.label_scale_factor)
+        else:
+            label_fractions = np.zeros((len(upper_lefts), 3))
+            label_fractions[:, 0] = 1
+        labels = label_fractions.argmax(axis=1) - 1
+
+        shard_dir = pjoin(self.output_dir, os.path.dirname(filepath))
+        utils.exists_or_makedirs(shard_dir)
+        with ShardWriter(pjoin(shard_dir, f'{slide.filename}-%05d.tar')) as writer:
+            for (x, y), tissue_fraction, label, fractions in zip(upper_lefts, tissue_fractions, labels, label_fractions):
+                tile = slide.get_tile((int(x), int(y)), self.patch_size, self.level)
+                buffer = io.BytesIO()
+                tile.save(buffer, format='JPEG' if self.image_format == 'jpg' else self.image_format.upper())
+                writer.write(key=f'{slide.filename}_{self.level}_{x}_{y}',
+                            image_bytes=buffer.getvalue(),
+                            image_format=self.image_format,
+                            metadata={'slide': filepath, 'level': self.level, 'x': int(x), 'y': int(y),
+                                        'size': self.patch_size, 'label': int(label),
+                                        'negative_fraction': float(fractions[1]), 'positive_fraction': float(fractions[2]),
+                                        'tissue_fraction': float(tissue_fraction)})
+
+        summary = {'slide': filepath,
+                    'level': self.level, 'patch_size': self.patch_size, 'stride': self.stride,
+                    'patch_count': len(upper_lefts),
+                    'label_counts': {str(label): int(count) for label, count in zip(*np.unique(labels, return_counts=True))},
+                    'shards': [os.path.relpath(path, self.output_dir) for path in writer.shards]}
+        utils.atomic_write_json(done_path, summary)
+        # shards of an earlier extraction with a different grid that were not overwritten
+        for shard in set((previous_summary or {}).get('shards', [])) - set(summary['shards']):
+            if os.path.exists(pjoin(self.output_dir, shard)):
+                os.remove(pjoin(self.output_dir, shard))
+        print(f'{len(upper_lefts)} patches of {filepath} written to {len(writer.shards)} shards.')
+        return summary
+
+    def _extract_worker(self, args):
+        filepath, force_reextract = args
+        try:
+            return self.extract_slide(filepath, force_reextract)
+        except Exception as e:
+            print(f'Failed to extract patches of {filepath}: {e!r}')
+            return {'slide': filepath, 'error': repr(e)}
+
+    def multithread_extract(self, num_thread=0, force_reextract=False):
+        timer = utils.Time()
+
+        num_thread = multiprocessing.cpu_count() if num_thread==0 else num_thread
+        num_thread = max(min(num_thread, len(self.filepath_list)), 1)
+        print(f"Number of processes: {num_thread}")
+        print(f"Number of slides: {len(self.filepath_list)}")
+
+        with multiprocessing.Pool(num_thread) as pool:
+            summaries = list(pool.imap_unordered(self._extract_worker,
+                                                    [(filepath, force_reextract) for filepath in self.filepath_list]))
+
+        failed = [summary for summary in summaries if 'error' in summary]
+        print(f"{sum(summary.get('patch_count', 0) for summary in summaries)} patches from "
+              f"{len(summaries) - len(failed)} slides, {len(failed)} failed")
+        for summary in failed:
+            print(f"\t{summary['slide']}: {summary['error']}")
+
+        timer.elapsed_display()
+        return summaries
+
+
+def extract_all_slides(num_thread=0, force_reextract=False, **kwargs):
+    extractor = PatchExtractor(utils.get_dataset_item_list(), **kwargs)
+    return extractor.multithread_extract(num_thread, force_reextract)
+
+
+if __name__ == '__main__':
+    extract_all_slides(num_thread=16)
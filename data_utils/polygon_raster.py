@@ -0,0 +1,91 @@
+import numpy as np
+
+# fixed-point precision of the polygon edges in OpenCV's fillPoly
+XY_SHIFT = 16
+
+
+def _outline_window(points, x0, y0, x1, y1, out):
+    """
+    Mark in out, the (y1-y0, x1-x0) window, the 8-connected Bresenham pixels of every polygon edge,
+    stepping like OpenCV's LineIterator: from the left end point along the major axis, with a minor
+    step whenever the error term gets negative.
+    """
+    starts, ends = points, np.roll(points, 1, axis=0)
+    near = (np.minimum(starts[:, 0], ends[:, 0]) < x1) & (np.maximum(starts[:, 0], ends[:, 0]) >= x0) & \
+            (np.minimum(starts[:, 1], ends[:, 1]) < y1) & (np.maximum(starts[:, 1], ends[:, 1]) >= y0)
+    for (ax, ay), (bx, by) in zip(ends[near].tolist(), starts[near].tolist()):
+        if bx < ax:
+            ax, ay, bx, by = bx, by, ax, ay
+        dx, dy = bx - ax, abs(by - ay)
+        sy = 1 if by >= ay else -1
+        if dx >= dy:
+            steps = np.arange(max(x0 - ax, 0), min(x1 - ax, dx + 1))
+            xs = ax + steps
+            ys = ay + sy * ((2*dy*steps + dx - 1) // (2*dx)) if dx > 0 else np.full_like(steps, ay)
+        else:
+            if sy > 0:
+                steps = np.arange(max(y0 - ay, 0), min(y1 - ay, dy + 1))
+            else:
+                steps = np.arange(max(ay - y1 + 1, 0), min(ay - y0 + 1, dy + 1))
+            ys = ay + sy * steps
+            xs = ax + (2*dx*steps + dy - 1) // (2*dy)
+        inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        out[ys[inside] - y0, xs[inside] - x0] = True
+
+
+def _fill_window(points, x0, y0, x1, y1, out):
+    """
+    Mark in out the scanline spans of the polygon like OpenCV's FillEdgeCollection: every edge that is
+    not horizontal covers rows [top, bottom) with fixed-point x stepping, and spans join the sorted edge
+    crossings of a row pairwise.
+    """
+    starts, ends = points.astype(np.int64), np.roll(points, 1, axis=0).astype(np.int64)
+    sloped = starts[:, 1] != ends[:, 1]
+    starts, ends = starts[sloped], ends[sloped]
+    numerator = (starts[:, 0] - ends[:, 0]) << XY_SHIFT
+    denominator = starts[:, 1] - ends[:, 1]
+    # C integer division truncates toward zero
+    slopes = np.sign(numerator) * np.sign(denominator) * (np.abs(numerator) // np.abs(denominator))
+    downward = ends[:, 1] < starts[:, 1]
+    tops = np.where(downward, ends[:, 1], starts[:, 1])
+    bottoms = np.where(downward, starts[:, 1], ends[:, 1])
+    top_xs = np.where(downward, ends[:, 0], starts[:, 0]) << XY_SHIFT
+
+    active = (tops < y1) & (bottoms > y0)
+    if not active.any():
+        return
+    tops, bottoms, top_xs, slopes = tops[active], bottoms[active], top_xs[active], slopes[active]
+    rows = np.arange(y0, y1)
+    covers = (rows[None, :] >= tops[:, None]) & (rows[None, :] < bottoms[:, None])
+    edge_ids, row_ids = np.nonzero(covers)
+    crossings = top_xs[edge_ids] + (rows[row_ids] - tops[edge_ids]) * slopes[edge_ids]
+    order = np.lexsort((crossings, row_ids))
+    # every row is crossed an even number of times, so pairs never straddle two rows
+    row_ids, crossings = row_ids[order][0::2], crossings[order].reshape(-1, 2)
+    lefts = np.clip((crossings.min(axis=1) + (1 << XY_SHIFT) - 1) >> XY_SHIFT, x0, x1) - x0
+    rights = np.clip((crossings.max(axis=1) >> XY_SHIFT) + 1, x0, x1) - x0
+    keep = lefts < rights
+    row_ids, lefts, rights = row_ids[keep], lefts[keep], rights[keep]
+    spans = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int32)
+    np.add.at(spans, (row_ids, lefts), 1)
+    np.add.at(spans, (row_ids, rights), -1)
+    out |= np.cumsum(spans, axis=1)[:, :-1] > 0
+
+
+def fill_polygon_window(points, upper_left, lower_right):
+    """
+    Window [upper_left, lower_right) of cv2.fillPoly(mask, [points], 1) as a boolean array, for a polygon
+    lying inside the mask, computed in O(window + edges) without drawing the whole polygon.
+
+    OpenCV rebuilds the edges that cross the image border from clipped end points, so drawing the shifted
+    polygon into a window-sized image changes pixels far inside the window; reproducing its unclipped
+    rasterization rules instead keeps the window identical to the full-size drawing.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    (x0, y0), (x1, y1) = upper_left, lower_right
+    out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=bool)
+    if out.size == 0 or len(points) == 0:
+        return out
+    _outline_window(points, x0, y0, x1, y1, out)
+    _fill_window(points, x0, y0, x1, y1, out)
+    return out
@@ -1,57 +1,103 @@
-import multiprocessing
-from typing import Type
-from matplotlib.pyplot import sca
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import openslide
 import numpy as np
 import math
-import PIL
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = 20000000000
 import os
 from os.path import join as pjoin
 
-from data_config import *
-import utils
+from .data_config import *
+from . import utils
+from . import metrics
+from .tiled_tiff import save_tiled_tiff
+
+
+SLIDE_METADATA_PROPERTIES = [openslide.PROPERTY_NAME_VENDOR,
+                            openslide.PROPERTY_NAME_OBJECTIVE_POWER,
+                            openslide.PROPERTY_NAME_MPP_X,
+                            openslide.PROPERTY_NAME_MPP_Y]
+
+
+def _read_rgb(slide_handle, location, level, size):
+    region = utils.read_region_rgba(slide_handle, location, level, size)
+    with metrics.timer('convert_rgb'):
+        return region.convert('RGB')
 
 
 class Slide(object):
-    def __init__(self, filepath):
+    def __init__(self, filepath, tile_cache=None):
         self.filepath = filepath
         self.filename = os.path.splitext(os.path.basename(filepath))[0]
+        # optional TileCache/SharedTileCache, region reads on the level-pixel grid (all level-0 reads) are then
+        # assembled from cached grid tiles, see _is_cacheable
+        self.tile_cache = tile_cache
+
+        self._slide = None
+        self._associated_images = {}
+
+        metadata = utils.load_slide_metadata(filepath)
+        if metadata is None:
+            metadata = self._read_metadata()
+            utils.save_slide_metadata(filepath, metadata)
+        self.metadata = metadata
+
+        self.dimensions = tuple(metadata['dimensions'])
+        self.level_count = metadata['level_count']
+        self.level_dimensions = tuple(tuple(value) for value in metadata['level_dimensions'])
+        self.level_downsamples = [round(value) for value in metadata['level_downsamples']]
+        self.properties = metadata['properties']
+
+    def _read_metadata(self):
+        return {'dimensions': list(self.slide.dimensions),
+                'level_count': self.slide.level_count,
+                'level_dimensions': [list(value) for value in self.slide.level_dimensions],
+                'level_downsamples': list(self.slide.level_downsamples),
+                'associated_images': list(self.slide.associated_images.keys()),
+                'properties': {name: self.slide.properties.get(name) for name in SLIDE_METADATA_PROPERTIES}}
+
+    @property
+    def slide(self):
+        if self._slide is None:
+            self._slide = utils.open_slide(self.filepath)
+        return self._slide
 
-        self.slide = utils.open_slide(filepath)
-        associated_images = dict(self.slide.associated_images)
-        self.thumbnail = associated_images['thumbnail'].convert('RGB')
-        self.associated_label = associated_images['label'].convert('RGB')
-        self.associated_macro = associated_images['macro'].convert('RGB')
+    def _get_associated_image(self, name):
+        if name not in self._associated_images:
+            self._associated_images[name] = self.slide.associated_images[name].convert('RGB')
+        return self._associated_images[name]
 
-        self.dimensions = self.slide.dimensions
-        self.level_count = self.slide.level_count
-        self.level_dimensions = self.slide.level_dimensions
-        self.level_downsamples = [round(value) for value in self.slide.level_downsamples]
+    @property
+    def thumbnail(self):
+        return self._get_associated_image('thumbnail')
+
+    @property
+    def associated_label(self):
+        return self._get_associated_image('label')
+
+    @property
+    def associated_macro(self):
+        return self._get_associated_image('macro')
         
     def __str__(self):
         level_info = ['Downsample %sX, %s' % (self.level_downsamples[idx], self.level_dimensions[idx])  for idx in range(self.level_count)]
         info_str = f'[{self.filepath}]: {self.dimensions}\n'
         info_str += '\tLevels: %s\n' % ('\n\t\t'.join(level_info))
-        info_str += f'\tAssociated thumbnail image: {self.thumbnail}\n'
-        info_str += f'\tAssociated label image: {self.associated_label}\n'
-        info_str += f'\tAssociated macro image: {self.associated_macro}'
+        info_str += '\tAssociated images: %s' % (', '.join(self.metadata['associated_images']))
         return info_str
 
     def pil_image(self, scale_factor):
         if scale_factor in self.level_downsamples:
             level = self.level_downsamples.index(scale_factor)
-            image = self.slide.read_region(location=(0,0),
-                                            level=level, 
-                                            size=self.level_dimensions[level]).convert('RGB')
+            image = _read_rgb(self.slide, (0,0), level, self.level_dimensions[level])
         else:
-            level = self.slide.get_best_level_for_downsample()
-            image = self.slide.read_region(location=(0,0),
-                                            level=level, 
-                                            size=self.level_dimensions[level]).convert('RGB')
-            new_size = (round(self.level_dimensions[level][idx]/scale_factor) for idx in range(2))
-            image = image.resize(new_size, Image.BILINEAR)
+            level = self.slide.get_best_level_for_downsample(scale_factor)
+            image = _read_rgb(self.slide, (0,0), level, self.level_dimensions[level])
+            new_size = tuple(round(self.dimensions[idx]/scale_factor) for idx in range(2))
+            with metrics.timer('resize'):
+                image = image.resize(new_size, Image.BILINEAR)
+            metrics.count('pixels_resized', new_size[0]*new_size[1])
         return image
 
     def numpy_image(self, scale_factor):
@@ -59,22 +105,93 @@ class Slide(object):
         return np.asarray(pil_image)
 
     def save_converted_image(self, scale_factor, force_reconvert_when_exists=False):
+        return self.save_converted_images([scale_factor], force_reconvert_when_exists)[scale_factor]
+
+    def save_converted_images(self, scale_factors, force_reconvert_when_exists=False, image_format=ARGS_convert_image_format,
+                                tiff_tile_size=ARGS_convert_tile_size, tiff_compression=ARGS_convert_tiff_compression,
+                                output_root=None):
+        """
+        Convert the slide at several scales in one pass, finest first. A scale matching a native level is read
+        from that level, any other one is downsized from the previous, finer output when there is one, so the
+        slide is streamed at most once. Outputs go to <output_root>/<scale>X, by default the converted dirs of
+        data_config. Returns {scale_factor: image_path}.
+        """
         print(self.__str__())
-        img_store_dir = pjoin(ARGS_converted_dir, os.path.splitext(self.filepath)[0])
-        utils.exists_or_makedirs(img_store_dir)
-        if not os.path.exists(pjoin(img_store_dir, 'macro.jpg')) or force_reconvert_when_exists :
-            self.associated_macro.save(pjoin(img_store_dir, 'macro.jpg'))
-        if not os.path.exists(pjoin(img_store_dir, 'label.jpg')) or force_reconvert_when_exists:
-            self.associated_label.save(pjoin(img_store_dir, 'label.jpg'))
-        if not os.path.exists(pjoin(img_store_dir, 'thumbnail.jpg')) or force_reconvert_when_exists:
-            self.thumbnail.save(pjoin(img_store_dir, 'thumbnail.jpg'))
-        if not os.path.exists(pjoin(img_store_dir, f'{self.filename}.{ARGS_convert_image_format}')) or force_reconvert_when_exists:
-            try:
-                self.pil_image(scale_factor).save(pjoin(img_store_dir, f'{self.filename}.{ARGS_convert_image_format}'))
-            except openslide.lowlevel.OpenSlideError as e:
-                print(repr(e))
-        print(f'Slide image {self.filepath} saved.\n')
-        
+        image_paths = {}
+        finer_array = None
+        for scale_factor in sorted(scale_factors):
+            converted_dir = pjoin(output_root, f'{scale_factor}X') if output_root is not None \
+                                else utils.get_converted_dir_by_scale_factor(scale_factor)
+            img_store_dir = pjoin(converted_dir, os.path.splitext(self.filepath)[0])
+            utils.exists_or_makedirs(img_store_dir)
+            for name, filename in [('macro', 'macro.jpg'), ('label', 'label.jpg'), ('thumbnail', 'thumbnail.jpg')]:
+                if name not in self.metadata['associated_images']:
+                    continue
+                if not os.path.exists(pjoin(img_store_dir, filename)) or force_reconvert_when_exists:
+                    utils.atomic_save_image(self._get_associated_image(name), pjoin(img_store_dir, filename))
+            image_path = pjoin(img_store_dir, f'{self.filename}.{image_format}')
+            image_paths[scale_factor] = image_path
+            if os.path.exists(image_path) and not force_reconvert_when_exists:
+                continue
+
+            if finer_array is None or scale_factor in self.level_downsamples:
+                image_array = self.get_scaled_image_by_tile(scale_factor)
+            else:
+                scaled_size = (max(round(self.dimensions[0]/scale_factor), 1), max(round(self.dimensions[1]/scale_factor), 1))
+                with metrics.timer('resize'):
+                    image_array = np.asarray(Image.fromarray(finer_array).resize(scaled_size, Image.BILINEAR))
+                metrics.count('pixels_resized', scaled_size[0]*scaled_size[1])
+            # only the nearest finer output is kept, the next scale cascades from it
+            finer_array = image_array
+
+            with metrics.timer('encode'):
+                if image_format in ['tif', 'tiff']:
+                    save_tiled_tiff(image_array, image_path, tiff_tile_size, tiff_compression)
+                else:
+                    utils.atomic_save_image(Image.fromarray(image_array), image_path)
+            metrics.count('bytes_written', os.path.getsize(image_path))
+            print(f'Slide image {self.filepath} saved at {scale_factor}X.')
+        return image_paths
+
+    def get_tile(self, location, size, level=0):
+        if isinstance(size, int):
+            size = (size, size)
+        elif not (isinstance(size, tuple) or isinstance(size, list)):
+            raise TypeError('size should be list, tuple or int')
+        if self.tile_cache is not None and self._is_cacheable(location, level):
+            return Image.fromarray(self._read_region_from_cache(location, size, level))
+        return _read_rgb(self.slide, location, level, size)
+
+    def _is_cacheable(self, location, level):
+        """
+        Whether a read at location falls on the level-pixel grid of the cached tiles. Elsewhere OpenSlide
+        resamples at the fractional level position, which grid tiles cannot reproduce, so such reads
+        (at levels with non-integer downsamples, as in most SVS files, or unaligned locations) bypass the cache.
+        """
+        downsample = self.metadata['level_downsamples'][level]
+        return float(downsample).is_integer() and location[0] % downsample == 0 and location[1] % downsample == 0
+
+    def _read_region_from_cache(self, location, size, level):
+        tile_size = self.tile_cache.tile_size
+        downsample = self.metadata['level_downsamples'][level]
+        level_x, level_y = round(location[0]/downsample), round(location[1]/downsample)
+        image_array = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        for tile_y in range(math.floor(level_y/tile_size), math.ceil((level_y+size[1])/tile_size)):
+            for tile_x in range(math.floor(level_x/tile_size), math.ceil((level_x+size[0])/tile_size)):
+                key = (self.filepath, level, tile_x, tile_y)
+                tile = self.tile_cache.get(key)
+                if tile is None:
+                    tile = np.asarray(_read_rgb(self.slide, (round(tile_x*tile_size*downsample), round(tile_y*tile_size*downsample)),
+                                                level, (tile_size, tile_size)))
+                    self.tile_cache.put(key, tile)
+
+                # intersection of the grid tile with the requested region, in level coordinates
+                left, top = max(tile_x*tile_size, level_x), max(tile_y*tile_size, level_y)
+                right, bottom = min((tile_x+1)*tile_size, level_x+size[0]), min((tile_y+1)*tile_size, level_y+size[1])
+                image_array[top-level_y:bottom-level_y, left-level_x:right-level_x, :] = \
+                    tile[top-tile_y*tile_size:bottom-tile_y*tile_size, left-tile_x*tile_size:right-tile_x*tile_size, :]
+        return image_array
+
     def get_fullsize_tile(self, location, size):
         if isinstance(size, int):
             size = (size, size)
@@ -82,78 +199,97 @@ class Slide(object):
             raise TypeError('size should be list, tuple or int')
         if size[0]*size[1] >= 1024 * 1024:
             Warning('Too large tile required.')
-        tile = self.slide.read_region(location=location, level=0, size=size).convert('RGB')
-        return tile
+        return self.get_tile(location, size, level=0)
 
     def get_fullsize_tile_by_bbox(self, upper_left, lower_rigth):
         return self.get_fullsize_tile(location=upper_left,
                                         size=(lower_rigth[0]-upper_left[0], lower_rigth[1]-upper_left[1]))
 
-    def get_fullsize_region_by_tile(self, raw_location, raw_size, tile_size=1024):
+    def get_fullsize_region_by_tile(self, raw_location, raw_size, tile_size=1024, num_workers=1):
+        """
+        Read a level-0 region into an (H, W, 3) uint8 array tile by tile.
+        With num_workers > 1 tiles are read concurrently, each worker thread using its own OpenSlide handle.
+        """
         if isinstance(raw_size, int):
             raw_size = (raw_size, raw_size)
         elif not (isinstance(raw_size, tuple) or isinstance(raw_size, list)):
             raise TypeError('size should be list, tuple or int')
 
-        width_tile_count, height_tile_count = math.ceil(raw_size[0]/tile_size), math.ceil(raw_size[1]/tile_size)
-        last_tile_width = raw_size[0]%tile_size if raw_size[0]%tile_size!=0 else tile_size
-        last_tile_height = raw_size[1]%tile_size if raw_size[1]%tile_size!=0 else tile_size
-        image_array = np.zeros((raw_size[0], raw_size[1], 3), dtype=np.uint8)
-            
-        print(f'width_count{width_tile_count} height_count{height_tile_count}')
-
-        anchor_point = [0,0]
-        raw_img_pos = list(raw_location)
-        for row in range(0,height_tile_count):
-            for column in range(0,width_tile_count):
-                tile_width = tile_size if column != width_tile_count-1 else last_tile_width
-                tile_height = tile_size if row != height_tile_count-1  else last_tile_height
-                image_array[anchor_point[0]:anchor_point[0]+tile_width, anchor_point[1]:anchor_point[1]+tile_height, :] = np.asarray(self.get_fullsize_tile(raw_img_pos, (tile_height, tile_width)))
-                anchor_point[0] += tile_width
-                raw_img_pos[0] += tile_width
-            anchor_point[1] += tile_height
-            anchor_point[0] = 0
-            raw_img_pos[1] += tile_height
-            raw_img_pos[0] = raw_location[0]
+        image_array = np.zeros((raw_size[1], raw_size[0], 3), dtype=np.uint8)
+        tiles = [(x, y, min(tile_size, raw_size[0]-x), min(tile_size, raw_size[1]-y))
+                    for y in range(0, raw_size[1], tile_size)
+                    for x in range(0, raw_size[0], tile_size)]
+
+        if num_workers <= 1:
+            for x, y, tile_width, tile_height in tiles:
+                tile = self.get_fullsize_tile((raw_location[0]+x, raw_location[1]+y), (tile_width, tile_height))
+                image_array[y:y+tile_height, x:x+tile_width, :] = np.asarray(tile)
+            return image_array
+
+        # OpenSlide handles are not shared between threads, each worker lazily opens its own
+        local = threading.local()
+        def read_tile(tile):
+            x, y, tile_width, tile_height = tile
+            if not hasattr(local, 'slide'):
+                local.slide = utils.open_slide(self.filepath)
+            tile = _read_rgb(local.slide, (raw_location[0]+x, raw_location[1]+y), 0, (tile_width, tile_height))
+            image_array[y:y+tile_height, x:x+tile_width, :] = np.asarray(tile)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for _ in executor.map(read_tile, tiles):
+                pass
         return image_array
 
-#TODO
     def get_scaled_region_by_tile(self, raw_location, raw_size, scale, tile_size=1024):
+        """
+        Downsample a level-0 region tile by tile into a preallocated (H, W, 3) array.
+        Peak memory is about the output array plus one tile.
+        """
         if isinstance(raw_size, int):
             raw_size = (raw_size, raw_size)
         elif not (isinstance(raw_size, tuple) or isinstance(raw_size, list)):
             raise TypeError('size should be int, tuple or list')
 
-        if scale in self.level_dimensions:
-            raw_location = (round(raw_location[0]/scale), round(raw_location[1]/scale))
-            level = self.level_dimensions.index(scale)
-            raw_size = self.level_dimensions[level]
+        if scale in self.level_downsamples:
+            # native level: use its exact downsample so the output matches the level dimensions
+            level = self.level_downsamples.index(scale)
+            scale = self.slide.level_downsamples[level]
         else:
-            level = 0 
-        last_tile_width = raw_size[0]%tile_size if raw_size[0]%tile_size!=0 else tile_size
-        last_tile_height = raw_size[1]%tile_size if raw_size[1]%tile_size!=0 else tile_size
-        image_array = None
-        width_tile_count, height_tile_count = math.ceil(raw_size[0]/tile_size), math.ceil(raw_size[1]/tile_size)
-        raw_image_pos = list(raw_location)
-        for row in range(0, height_tile_count):
-            for column in range(0, width_tile_count):
-                tile_width = tile_size if column!=width_tile_count-1 else last_tile_width
-                tile_height = tile_size if row!=height_tile_count-1 else last_tile_height
-                tile_image = self.get_fullsize_tile(raw_image_pos, (tile_width, tile_height))
-                scaled_tile_width, scaled_tile_height = round(tile_width/scale), round(tile_height/scale)
-                scaled_tile_image = tile_image.resize((scaled_tile_width, scaled_tile_height), Image.BILINEAR)
-                scaled_tile_array = np.asarray(scaled_tile_image)
-                #TODO
-                raise NotImplementedError
-                raw_image_pos[0] += tile_width
-            raw_image_pos[0] = raw_location[0]
-            raw_image_pos[1] += tile_height
-
-    def get_fullsize_image_by_tile(self):
+            level = self.slide.get_best_level_for_downsample(scale)
+        level_downsample = self.slide.level_downsamples[level]
+        # scale still to apply after reading from the chosen level
+        relative_scale = scale / level_downsample
+
+        scaled_size = (max(round(raw_size[0]/scale), 1), max(round(raw_size[1]/scale), 1))
+        image_array = np.zeros((scaled_size[1], scaled_size[0], 3), dtype=np.uint8)
+
+        # the grid is laid out on the output image so that neighbouring tiles never overlap or leave gaps
+        scaled_tile_size = max(math.floor(tile_size / relative_scale), 1)
+        for scaled_y in range(0, scaled_size[1], scaled_tile_size):
+            scaled_tile_height = min(scaled_tile_size, scaled_size[1] - scaled_y)
+            level_y0 = round(scaled_y * relative_scale)
+            level_y1 = round((scaled_y + scaled_tile_height) * relative_scale)
+            for scaled_x in range(0, scaled_size[0], scaled_tile_size):
+                scaled_tile_width = min(scaled_tile_size, scaled_size[0] - scaled_x)
+                level_x0 = round(scaled_x * relative_scale)
+                level_x1 = round((scaled_x + scaled_tile_width) * relative_scale)
+
+                location = (raw_location[0] + round(level_x0 * level_downsample),
+                            raw_location[1] + round(level_y0 * level_downsample))
+                tile_image = self.get_tile(location, (max(level_x1 - level_x0, 1), max(level_y1 - level_y0, 1)), level)
+                if tile_image.size != (scaled_tile_width, scaled_tile_height):
+                    with metrics.timer('resize'):
+                        tile_image = tile_image.resize((scaled_tile_width, scaled_tile_height), Image.BILINEAR)
+                    metrics.count('pixels_resized', scaled_tile_width*scaled_tile_height)
+                image_array[scaled_y:scaled_y+scaled_tile_height, scaled_x:scaled_x+scaled_tile_width, :] = np.asarray(tile_image)
+        return image_array
+
+    def get_fullsize_image_by_tile(self, num_workers=1):
         return self.get_fullsize_region_by_tile(raw_location=(0,0), 
-                                                raw_size=self.dimensions)
+                                                raw_size=self.dimensions,
+                                                num_workers=num_workers)
 
     def get_scaled_image_by_tile(self, scale):
         return self.get_scaled_region_by_tile(raw_location=(0,0),
-                                            raw_size=self.level_dimensions,
+                                            raw_size=self.dimensions,
                                             scale=scale)
@@ -1,103 +1,434 @@
 import multiprocessing
+import queue
+import datetime
+import time
+import traceback
+import json
+import csv
 from os.path import getsize
 import openslide
 import numpy as np
 import math
-import PIL
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = 20000000000
-import random
-from matplotlib import pyplot as plt
 
-from data_config import *
-from slide import Slide
-import utils
+from .data_config import *
+from .slide import Slide
+from . import utils
+from . import metrics
+
+
+def _parse_scale_factors(value):
+    return [float(scale) if '.' in scale else int(scale) for scale in value.split(',') if scale.strip()]
+
+
+class ConvertConfig:
+    """
+    Settings of a conversion run: data_config defaults, overridden by HISTOPATH_* environment variables,
+    overridden by the keyword arguments. The config travels with every task to the pool workers, so that
+    converters with different settings can share a pool instead of relying on module globals.
+    """
+
+    ENVIRONMENT_VARIABLES = {'scale_factors': ('HISTOPATH_SCALE_FACTORS', _parse_scale_factors),
+                                'image_format': ('HISTOPATH_CONVERT_FORMAT', str),
+                                'tile_size': ('HISTOPATH_CONVERT_TILE_SIZE', int),
+                                'tiff_compression': ('HISTOPATH_CONVERT_TIFF_COMPRESSION', str),
+                                'memory_budget': ('HISTOPATH_CONVERT_MEMORY_BUDGET', int),
+                                'output_root': ('HISTOPATH_CONVERTED_ROOT', str)}
+
+    def __init__(self, scale_factors=None, image_format=None, tile_size=None, tiff_compression=None,
+                    memory_budget=None, output_root=None):
+        settings = {'scale_factors': [ARGS_scale_factor],
+                    'image_format': ARGS_convert_image_format,
+                    'tile_size': ARGS_convert_tile_size,
+                    'tiff_compression': ARGS_convert_tiff_compression,
+                    'memory_budget': ARGS_convert_memory_budget,
+                    'output_root': pjoin(ARGS_dataset_dir, 'preprocessed', ARGS_dataset_chosen)}
+        for name, (variable, parse) in self.ENVIRONMENT_VARIABLES.items():
+            if os.environ.get(variable):
+                settings[name] = parse(os.environ[variable])
+        arguments = {'scale_factors': scale_factors, 'image_format': image_format, 'tile_size': tile_size,
+                        'tiff_compression': tiff_compression, 'memory_budget': memory_budget, 'output_root': output_root}
+        settings.update({name: value for name, value in arguments.items() if value is not None})
+        if not isinstance(settings['scale_factors'], (list, tuple)):
+            settings['scale_factors'] = [settings['scale_factors']]
+        settings['scale_factors'] = sorted(set(settings['scale_factors']))
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+    def get_converted_dir(self, scale_factor):
+        return pjoin(self.output_root, f'{scale_factor}X')
+
+    def __repr__(self):
+        return f'ConvertConfig({self.__dict__})'
 
 
 class SlideConverter:
-    def __init__(self, filepath_list, scale_factor):
+    def __init__(self, filepath_list, scale_factors=None, memory_budget=None,
+                    force_reconvert=False, verify_checksum=False, config=None):
+        """
+        scale_factors is a scale or a list of scales, all converted in one pass over each slide.
+        Settings not given here come from config, a ConvertConfig built from the environment by default.
+        """
         self.filepath_list = filepath_list
-        self.scale_factor = scale_factor
-        
-    def _converter(self, slide_paths_list):
-        for slide_path in slide_paths_list:
+        self.config = config if config is not None else ConvertConfig()
+        if scale_factors is not None or memory_budget is not None:
+            self.config = ConvertConfig(**{**self.config.__dict__,
+                                            'scale_factors': scale_factors if scale_factors is not None else self.config.scale_factors,
+                                            'memory_budget': memory_budget if memory_budget is not None else self.config.memory_budget})
+        self.scale_factors = self.config.scale_factors
+        # bytes the slides converting at the same time may hold, half of the physical memory by default
+        self.memory_budget = self.config.memory_budget if self.config.memory_budget is not None else utils.get_physical_memory() // 2
+        self.force_reconvert = force_reconvert
+        self.verify_checksum = verify_checksum
+        self.manifest_paths = {scale_factor: pjoin(self.config.get_converted_dir(scale_factor), 'manifest.json')
+                                for scale_factor in self.scale_factors}
+
+    def load_manifest(self, scale_factor):
+        try:
+            with open(self.manifest_paths[scale_factor]) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self, scale_factor, manifest):
+        utils.exists_or_makedirs(os.path.dirname(self.manifest_paths[scale_factor]))
+        utils.atomic_write_json(self.manifest_paths[scale_factor], manifest)
+
+    def needs_conversion(self, slide_path, entry, scale_factor):
+        """
+        Whether a slide has to be (re)converted at scale_factor given its manifest entry: new, changed, failed,
+        converted with other settings, or with an output that is missing or does not match.
+        """
+        if self.force_reconvert or entry is None or entry.get('status') != 'ok':
+            return True
+        try:
+            source_stat = os.stat(utils.get_raw_item_fullpath(slide_path))
+            output_stat = os.stat(entry['output'])
+        except OSError:
+            return True
+        if (entry['source_size'], entry['source_mtime']) != (source_stat.st_size, source_stat.st_mtime):
+            return True
+        if (entry['scale_factor'], entry['format']) != (scale_factor, self.config.image_format):
+            return True
+        if entry['output_size'] != output_stat.st_size:
+            return True
+        return self.verify_checksum and utils.file_checksum(entry['output']) != entry['output_checksum']
+
+    def estimate_memory(self, slide, scale_factors):
+        # two neighbouring outputs + the PIL copy while encoding, plus one RGBA source tile and its RGB conversion
+        scaled_pixels = [math.ceil(slide.dimensions[0]/scale_factor) * math.ceil(slide.dimensions[1]/scale_factor)
+                            for scale_factor in scale_factors]
+        return max(scaled_pixels) * 3 * 3 + 1024 * 1024 * 7
+
+    def _converter(self, slide_path, scale_factors):
+        start = time.time()
+        metrics.reset()
+        try:
             print('Converting %s' % slide_path)
+            source_stat = os.stat(utils.get_raw_item_fullpath(slide_path))
             slide = Slide(slide_path)
-            slide.save_converted_image(self.scale_factor)
+            # the manifest decided these scales have to be converted, existing outputs are stale or partial
+            output_paths = slide.save_converted_images(scale_factors, force_reconvert_when_exists=True,
+                                                        image_format=self.config.image_format,
+                                                        tiff_tile_size=self.config.tile_size,
+                                                        tiff_compression=self.config.tiff_compression,
+                                                        output_root=self.config.output_root)
+            manifest_entries = {scale_factor: {'source': utils.get_raw_item_fullpath(slide_path),
+                                                'source_size': source_stat.st_size,
+                                                'source_mtime': source_stat.st_mtime,
+                                                'scale_factor': scale_factor,
+                                                'format': self.config.image_format,
+                                                'output': output_path,
+                                                'output_size': os.path.getsize(output_path),
+                                                'output_checksum': utils.file_checksum(output_path),
+                                                'status': 'ok'}
+                                for scale_factor, output_path in output_paths.items()}
+        except Exception as e:
+            return {'slide': slide_path, 'scale_factors': scale_factors, 'ok': False, 'error': repr(e),
+                    'traceback': traceback.format_exc(), 'elapsed': time.time() - start,
+                    'metrics': metrics.snapshot(slide_path, ok=False)}
+        return {'slide': slide_path, 'scale_factors': scale_factors, 'ok': True, 'elapsed': time.time() - start,
+                'manifest_entries': manifest_entries,
+                'metrics': metrics.snapshot(slide_path, ok=True, elapsed=time.time() - start)}
+
+    def _schedule(self, stale_scale_factors):
+        tasks, failed = [], []
+        for slide_path, scale_factors in stale_scale_factors.items():
+            try:
+                slide = Slide(slide_path)
+            except Exception as e:
+                failed.append({'slide': slide_path, 'scale_factors': scale_factors, 'ok': False, 'error': repr(e),
+                                'traceback': traceback.format_exc(), 'elapsed': 0})
+                continue
+            tasks.append((slide_path, slide.dimensions[0]*slide.dimensions[1], self.estimate_memory(slide, scale_factors), scale_factors))
+        # largest first, so that giant slides do not end up as stragglers
+        tasks.sort(key=lambda task: task[1], reverse=True)
+        return tasks, failed
 
     def multithread_convert(self, num_thread=0):
         timer = utils.Time()
 
+        manifests = {scale_factor: self.load_manifest(scale_factor) for scale_factor in self.scale_factors}
+        # scales each slide still needs, all of them are produced by one task
+        stale_scale_factors = {}
+        for slide_path in self.filepath_list:
+            scale_factors = [scale_factor for scale_factor in self.scale_factors
+                                if self.needs_conversion(slide_path, manifests[scale_factor].get(slide_path), scale_factor)]
+            if scale_factors:
+                stale_scale_factors[slide_path] = scale_factors
+        filepath_list = list(stale_scale_factors)
+        print(f"Scale factors: {', '.join(f'{scale_factor}X' for scale_factor in self.scale_factors)}")
+        print(f"{len(self.filepath_list) - len(filepath_list)} slides up to date, {len(filepath_list)} to convert")
+
+        def record_result(result):
+            for scale_factor in result['scale_factors']:
+                if result['ok']:
+                    manifests[scale_factor][result['slide']] = result['manifest_entries'][scale_factor]
+                else:
+                    manifests[scale_factor][result['slide']] = {'status': 'failed', 'error': result['error']}
+
         # how many processes to use
         num_thread = multiprocessing.cpu_count() if num_thread==0 else num_thread
-        pool = multiprocessing.Pool(num_thread)
-
-        num_images = len(self.filepath_list)
-        num_thread = min(num_thread, num_images)
-        images_per_process = math.ceil(num_images / num_thread)
+        tasks, results = self._schedule(stale_scale_factors)
+        for result in results:
+            record_result(result)
+        num_images = len(tasks)
+        num_thread = max(min(num_thread, num_images), 1)
 
         print(f"Number of processes: {num_thread}")
         print(f"Number of training images: {num_images}")
+        print(f"Memory budget: {self.memory_budget / 1024**3:.1f}GB")
 
-        idx_list = list(range(num_images))
-        random.shuffle(idx_list)
+        total_pixels = sum(task[1] for task in tasks)
+        done_pixels = 0
+        done_queue = queue.Queue()
+        running = {}
+        task_id = 0
+        pending = list(tasks)
+        with multiprocessing.Pool(num_thread) as pool:
+            while pending or running:
+                # Start the largest pending slides that fit in the memory budget. A slide larger than
+                # the whole budget still runs, but alone.
+                idx = 0
+                while idx < len(pending) and len(running) < num_thread:
+                    slide_path, pixels, memory, scale_factors = pending[idx]
+                    if running and sum(task[1] for task in running.values()) + memory > self.memory_budget:
+                        idx += 1
+                        continue
+                    pending.pop(idx)
+                    task_id += 1
+                    running[task_id] = (pixels, memory)
+                    pool.apply_async(self._converter, [slide_path, scale_factors],
+                                    callback=lambda result, task_id=task_id: done_queue.put((task_id, result)),
+                                    error_callback=lambda e, task_id=task_id, slide_path=slide_path, scale_factors=scale_factors: done_queue.put(
+                                        (task_id, {'slide': slide_path, 'scale_factors': scale_factors, 'ok': False, 'error': repr(e), 'elapsed': 0})))
 
-        # each task specifies a range of slides
-        results = []
-        for i in range(0, num_images, images_per_process):
-            slides_list = [self.filepath_list[idx] for idx in sorted(idx_list[i:i+images_per_process])]
-            results.append(pool.apply_async(self._converter, [slides_list]))
-        
-        for result in results:
-            result.get()
+                task_id_done, result = done_queue.get()
+                pixels, _ = running.pop(task_id_done)
+                results.append(result)
+                done_pixels += pixels
+                record_result(result)
+                for scale_factor in result['scale_factors']:
+                    self.save_manifest(scale_factor, manifests[scale_factor])
+
+                elapsed = timer.elapsed().total_seconds()
+                eta = elapsed / done_pixels * (total_pixels - done_pixels) if done_pixels else 0
+                print(f"[{len(results)}/{len(filepath_list)}] {result['slide']} "
+                      f"{'done' if result['ok'] else 'FAILED'} in {result['elapsed']:.1f}s, "
+                      f"ETA {datetime.timedelta(seconds=round(eta))}")
+
+        for scale_factor in self.scale_factors:
+            self.save_manifest(scale_factor, manifests[scale_factor])
+        failed = [result for result in results if not result['ok']]
+        print(f"Converted {len(results) - len(failed)} slides, {len(failed)} failed")
+        for result in failed:
+            print(f"\t{result['slide']}: {result['error']}")
+
+        if metrics.is_enabled():
+            metrics_records = [result.get('metrics') for result in results]
+            metrics.write_records(metrics_records)
+            metrics.print_summary(metrics_records, title='Conversion metrics')
 
         timer.elapsed_display()
+        return results
 
 
-def convert_all_slides(scale_factor, num_thread=0):
+def convert_all_slides(scale_factors=None, num_thread=0, force_reconvert=False, config=None):
     converter = SlideConverter(utils.get_dataset_item_list(),
-                                scale_factor)
-    converter.multithread_convert(num_thread)
+                                scale_factors,
+                                force_reconvert=force_reconvert,
+                                config=config)
+    return converter.multithread_convert(num_thread)
         
 
-def get_stats(scale_factor):
+STATS_FIELDS = ['path', 'source_size', 'source_mtime', 'width', 'height', 'file_size',
+                'level_count', 'level_dimensions', 'level_downsamples',
+                'objective_power', 'mpp_x', 'mpp_y', 'tissue_fraction']
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _tissue_fraction(image):
+    from .patch_extractor import get_tissue_mask
+    with metrics.timer('tissue_mask'):
+        return float(get_tissue_mask(np.asarray(image.convert('RGB'))).mean())
+
+
+def _converted_image_path(item, scale_factor, config):
+    return pjoin(config.get_converted_dir(scale_factor), os.path.splitext(item)[0],
+                    os.path.basename(os.path.splitext(item)[0]) + '.' + config.image_format)
+
+
+def _collect_item_stats(item, scale_factor, config):
+    """
+    Stats record of one dataset item, reading only headers plus the thumbnail for the tissue fraction.
+    Returns None when the converted image of the item, located through config, does not exist.
+    """
+    slide = Slide(item)
+    downsample = max(scale_factor, 1)
+    record = {'path': item,
+                'objective_power': _float_or_nan(slide.properties.get(openslide.PROPERTY_NAME_OBJECTIVE_POWER)) / downsample,
+                'mpp_x': _float_or_nan(slide.properties.get(openslide.PROPERTY_NAME_MPP_X)) * downsample,
+                'mpp_y': _float_or_nan(slide.properties.get(openslide.PROPERTY_NAME_MPP_Y)) * downsample}
     if scale_factor == 0:
-        path = ARGS_raw_dir
+        source_path = utils.get_raw_item_fullpath(item)
+        width, height = slide.dimensions
+        record.update({'level_count': slide.level_count,
+                        'level_dimensions': ';'.join(f'{w}x{h}' for w, h in slide.level_dimensions),
+                        'level_downsamples': ';'.join(str(value) for value in slide.level_downsamples)})
+        thumbnail = slide.thumbnail if 'thumbnail' in slide.metadata['associated_images'] else \
+                    slide.get_tile((0, 0), slide.level_dimensions[-1], slide.level_count-1)
     else:
-        path = utils.get_converted_dir_by_scale_factor(scale_factor)
-    
-    item_list = [pjoin(path, file) for file in utils.get_dataset_item_list()]
-    
-    w_list = []
-    h_list = []
-    shape_list = []
-    file_size_list = []
-    
+        source_path = _converted_image_path(item, scale_factor, config)
+        item_dir = os.path.dirname(source_path)
+        if not os.path.exists(source_path):
+            print(f'{source_path} not found')
+            return None
+        # opening only parses the header, the pixels are never decoded
+        with Image.open(source_path) as image:
+            width, height = image.size
+        record.update({'level_count': 1, 'level_dimensions': f'{width}x{height}', 'level_downsamples': str(scale_factor)})
+        thumbnail = Image.open(pjoin(item_dir, 'thumbnail.jpg')) if os.path.exists(pjoin(item_dir, 'thumbnail.jpg')) else None
+
+    source_stat = os.stat(source_path)
+    record.update({'source_size': source_stat.st_size,
+                    'source_mtime': source_stat.st_mtime,
+                    'width': width,
+                    'height': height,
+                    'file_size': source_stat.st_size / 1024**2,
+                    'tissue_fraction': _tissue_fraction(thumbnail) if thumbnail is not None else float('nan')})
+    return record
+
+
+def _collect_item_stats_worker(args):
+    item, scale_factor, config = args
+    metrics.reset()
+    try:
+        record = _collect_item_stats(item, scale_factor, config)
+    except Exception as e:
+        print(f'Failed to collect stats of {item}: {e!r}')
+        record = None
+    return record, metrics.snapshot(item, ok=record is not None)
+
+
+def _load_stats_table(table_path):
+    records = {}
+    try:
+        with open(table_path, newline='') as f:
+            for row in csv.DictReader(f):
+                for field in STATS_FIELDS:
+                    if field not in ['path', 'level_dimensions', 'level_downsamples']:
+                        row[field] = _float_or_nan(row[field])
+                for field in ['source_size', 'width', 'height', 'level_count']:
+                    row[field] = int(row[field])
+                records[row['path']] = row
+    except (OSError, KeyError, ValueError):
+        return {}
+    return records
+
+
+def _stats_source_stat(item, scale_factor, config):
+    if scale_factor == 0:
+        source_path = utils.get_raw_item_fullpath(item)
+    else:
+        source_path = _converted_image_path(item, scale_factor, config)
+    try:
+        return os.stat(source_path)
+    except OSError:
+        return None
+
+
+def collect_stats(scale_factor, num_thread=0, metrics_records=None, config=None):
+    """
+    Per-item stats records of the dataset (raw slides when scale_factor is 0), computed in a process pool
+    and cached in a CSV table next to the stats logs. Items whose source file did not change are reused.
+    Converted images are looked up with the output root and format of config, a ConvertConfig built from
+    the environment by default. The metrics of the collected items are appended to metrics_records when given.
+    """
+    config = config if config is not None else ConvertConfig()
+    tag = 'raw' if scale_factor==0 else f'{scale_factor}X'
+    table_path = pjoin(ARGS_stat_dir, f'{tag}_file_stats.csv')
+    cached_records = _load_stats_table(table_path)
+
+    item_list = utils.get_dataset_item_list()
+    records, stale_items = {}, []
+    for item in item_list:
+        record, source_stat = cached_records.get(item), _stats_source_stat(item, scale_factor, config)
+        if record is not None and source_stat is not None and \
+                (record['source_size'], record['source_mtime']) == (source_stat.st_size, source_stat.st_mtime):
+            records[item] = record
+        else:
+            stale_items.append(item)
+    print(f'{len(records)} cached stats records, {len(stale_items)} to collect')
+
+    if stale_items:
+        num_thread = multiprocessing.cpu_count() if num_thread==0 else num_thread
+        with multiprocessing.Pool(min(num_thread, len(stale_items))) as pool:
+            for record, item_metrics in pool.imap_unordered(_collect_item_stats_worker, [(item, scale_factor, config) for item in stale_items]):
+                if record is not None:
+                    records[record['path']] = record
+                if metrics_records is not None and item_metrics is not None:
+                    metrics_records.append(item_metrics)
+
+    records = [records[item] for item in item_list if item in records]
     utils.exists_or_makedirs(ARGS_stat_dir)
+    with utils.atomic_path(table_path) as tmp_path:
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=STATS_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    return records
 
+
+def get_stats(scale_factor, num_thread=0, config=None):
+    # plotting is only needed here, importing it at module level would slow down every pool worker
+    from matplotlib import pyplot as plt
+
+    metrics_records = []
+    records = collect_stats(scale_factor, num_thread, metrics_records, config)
+    if not records:
+        print(f"No stats records at {'raw' if scale_factor==0 else f'{scale_factor}X'}, nothing to report")
+        return
+    item_list = [record['path'] for record in records]
+    w_list = [record['width'] for record in records]
+    h_list = [record['height'] for record in records]
+    shape_list = [record['width']*record['height'] for record in records]
+    file_size_list = [record['file_size'] for record in records]
+    tissue_fraction_list = np.array([record['tissue_fraction'] for record in records])
     
     with open(pjoin(ARGS_stat_dir, 
                 '%s_file_info.log' % ('raw' if scale_factor==0 else f'{scale_factor}X')), 'w') as f:
-        for item_path in item_list:
-            if scale_factor == 0:
-                slide = Slide(item_path)
-                f.write(str(slide))
-                w, h = slide.dimensions
-                file_size_list.append(os.path.getsize(pjoin(ARGS_raw_dir, item_path)) / 1024**2)
-            else:
-                image_path = pjoin(utils.get_converted_dir_by_scale_factor(scale_factor),
-                                    os.path.splitext(item_path)[0],
-                                    os.path.basename(os.path.splitext(item_path)[0])+'.'+ARGS_convert_image_format)
-                try:
-                    image = Image.open(image_path)
-                except FileNotFoundError as e:
-                    print(e)
-                    continue
-                w, h = image.size
-                file_size_list.append(os.path.getsize(image_path) / 1024**2)
-            w_list.append(w)
-            h_list.append(h)
-            shape_list.append(w*h)
+        for record in records:
+            f.write(f"[{record['path']}]: ({record['width']}, {record['height']}) {record['file_size']:.1f}MB\n"
+                    f"\tLevels: {record['level_dimensions']} (downsamples {record['level_downsamples']})\n"
+                    f"\tMagnification: {record['objective_power']}X, MPP: {record['mpp_x']}x{record['mpp_y']}\n"
+                    f"\tTissue fraction: {record['tissue_fraction']:.3f}\n")
 
         w_list = np.array(w_list)
         h_list = np.array(h_list)
@@ -112,6 +443,8 @@ def get_stats(scale_factor):
         info_str += f'Min width file:\t#{w_list.argmin()} {item_list[int(w_list.argmin())]}: {w_list.min()}x{h_list[int(w_list.argmin())]}\n'
         info_str += f'Max height file:\t#{h_list.argmax()} {item_list[int(h_list.argmax())]}: {w_list[int(h_list.argmax())]}x{h_list.max()}\n'
         info_str += f'Min height file:\t#{h_list.argmin()} {item_list[int(h_list.argmin())]}: {w_list[int(h_list.argmin())]}x{h_list.min()}\n'
+        info_str += f'MPP:\tmean {np.nanmean([record["mpp_x"] for record in records]):.4f}, magnification mean {np.nanmean([record["objective_power"] for record in records]):.1f}X\n'
+        info_str += f'Tissue fraction:\tmean {np.nanmean(tissue_fraction_list):.3f}, min {np.nanmin(tissue_fraction_list):.3f}, max {np.nanmax(tissue_fraction_list):.3f}\n'
         print(info_str)
         f.write(info_str)
 
@@ -140,8 +473,12 @@ def get_stats(scale_factor):
         plt.tight_layout()
         plt.savefig(pjoin(ARGS_stat_dir, "%s-distribution-of-image-file-sizes.jpg" % ('raw' if scale_factor==0 else f'{scale_factor}X')))
 
+    if metrics.is_enabled():
+        metrics.write_records(metrics_records)
+        metrics.print_summary(metrics_records, title='Stats metrics')
+
 if __name__ == '__main__':
-    # convert_all_slides(ARGS_scale_factor, num_thread=16)
+    # convert_all_slides([4, ARGS_scale_factor, 64], num_thread=16)
     get_stats(scale_factor=ARGS_scale_factor)
 
     # converter = SlideConverter(utils.get_dataset_item_list()[:5],
@@ -0,0 +1,158 @@
+import threading
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict
+import numpy as np
+
+from .data_config import *
+
+
+class TileCache:
+    """
+    Byte-size bounded LRU cache of decoded RGB tiles, keyed by (slide path, level, tile column, tile row)
+    on a fixed grid of tile_size pixels in the coordinates of each level.
+    """
+
+    def __init__(self, max_bytes=ARGS_tile_cache_bytes, tile_size=ARGS_tile_cache_tile_size):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self.bytes += tile.nbytes
+            while self.bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted_tile = self._tiles.popitem(last=False)
+                self.bytes -= evicted_tile.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._tiles), 'bytes': self.bytes}
+
+
+def _key_hash(key):
+    # stable across processes, unlike hash(); 0 marks an empty slot
+    value = int.from_bytes(hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+    return value if value != 0 else 1
+
+
+class SharedTileCache:
+    """
+    TileCache counterpart living in shared memory, so that pool workers reuse each other's tiles.
+
+    Tiles are stored in fixed slots of tile_size x tile_size x 3 bytes and evicted least recently used
+    first. Create it in the parent process and hand it to the workers through inheritance, e.g.
+    multiprocessing.Pool(initializer=..., initargs=(cache,)), because its lock cannot be pickled otherwise.
+    Call unlink() in the parent once the workers are done.
+    """
+
+    _COUNTERS = ['clock', 'hits', 'misses', 'evictions']
+
+    def __init__(self, max_bytes=ARGS_tile_cache_bytes, tile_size=ARGS_tile_cache_tile_size):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.num_slots = max(max_bytes // (tile_size * tile_size * 3), 1)
+        self._lock = multiprocessing.Lock()
+        self._data_memory = shared_memory.SharedMemory(create=True, size=self.num_slots * tile_size * tile_size * 3)
+        self._index_memory = shared_memory.SharedMemory(create=True, size=(2 * self.num_slots + len(self._COUNTERS)) * 8)
+        self._attach()
+        self._index[:] = 0
+
+    def _attach(self):
+        self._data = np.ndarray((self.num_slots, self.tile_size, self.tile_size, 3), dtype=np.uint8,
+                                buffer=self._data_memory.buf)
+        self._index = np.ndarray((2 * self.num_slots + len(self._COUNTERS),), dtype=np.int64,
+                                buffer=self._index_memory.buf)
+        self._keys = self._index[:self.num_slots]
+        self._last_used = self._index[self.num_slots:2*self.num_slots]
+        self._counters = self._index[2*self.num_slots:]
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes, 'tile_size': self.tile_size, 'num_slots': self.num_slots,
+                'lock': self._lock, 'data_name': self._data_memory.name, 'index_name': self._index_memory.name}
+
+    def __setstate__(self, state):
+        self.max_bytes = state['max_bytes']
+        self.tile_size = state['tile_size']
+        self.num_slots = state['num_slots']
+        self._lock = state['lock']
+        self._data_memory = shared_memory.SharedMemory(name=state['data_name'])
+        self._index_memory = shared_memory.SharedMemory(name=state['index_name'])
+        self._attach()
+
+    def _tick(self, counter):
+        self._counters[self._COUNTERS.index(counter)] += 1
+        return self._counters[self._COUNTERS.index(counter)]
+
+    def get(self, key):
+        key_hash = _key_hash(key)
+        with self._lock:
+            slots = np.flatnonzero(self._keys == key_hash)
+            if len(slots) == 0:
+                self._tick('misses')
+                return None
+            self._last_used[slots[0]] = self._tick('clock')
+            self._tick('hits')
+            # copied under the lock, the slot may be reused as soon as it is released
+            return self._data[slots[0]].copy()
+
+    def put(self, key, tile):
+        if tile.shape != (self.tile_size, self.tile_size, 3):
+            return
+        key_hash = _key_hash(key)
+        with self._lock:
+            if (self._keys == key_hash).any():
+                return
+            slot = int(np.argmin(self._last_used))
+            if self._keys[slot] != 0:
+                self._tick('evictions')
+            self._data[slot] = tile
+            self._keys[slot] = key_hash
+            self._last_used[slot] = self._tick('clock')
+
+    def clear(self):
+        with self._lock:
+            self._keys[:] = 0
+            self._last_used[:] = 0
+
+    def stats(self):
+        with self._lock:
+            entries = int((self._keys != 0).sum())
+            return {'hits': int(self._counters[1]), 'misses': int(self._counters[2]), 'evictions': int(self._counters[3]),
+                    'entries': entries, 'bytes': entries * self.tile_size * self.tile_size * 3}
+
+    def close(self):
+        # the numpy views have to go before the shared memory can be closed
+        del self._data, self._index, self._keys, self._last_used, self._counters
+        self._data_memory.close()
+        self._index_memory.close()
+
+    def unlink(self):
+        self.close()
+        self._data_memory.unlink()
+        self._index_memory.unlink()
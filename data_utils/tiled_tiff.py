@@ -0,0 +1,89 @@
+import math
+import os
+import numpy as np
+from PIL import Image
+
+from .data_config import *
+from .utils import atomic_path
+
+
+def _import_tifffile():
+    try:
+        import tifffile
+    except ImportError as e:
+        raise ImportError('Tiled TIFF output requires tifffile (pip install tifffile)') from e
+    return tifffile
+
+
+def _iter_tiles(image_array, tile_size):
+    height, width = image_array.shape[:2]
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = image_array[y:y+tile_size, x:x+tile_size]
+            if tile.shape[:2] != (tile_size, tile_size):
+                padded_tile = np.zeros((tile_size, tile_size) + image_array.shape[2:], dtype=image_array.dtype)
+                padded_tile[:tile.shape[0], :tile.shape[1]] = tile
+                tile = padded_tile
+            yield tile
+
+
+def save_tiled_tiff(image_array, filepath, tile_size=ARGS_convert_tile_size, compression=ARGS_convert_tiff_compression):
+    """
+    Save an (H, W, 3) uint8 array as a tiled, per-tile compressed pyramidal TIFF.
+
+    Each level halves the previous one until it fits in one tile. Levels are stored as successive
+    reduced-resolution pages, the layout OpenSlide reads as a generic tiled TIFF. The file is written
+    under a temporary name and renamed when complete.
+    """
+    tifffile = _import_tifffile()
+    with atomic_path(filepath) as tmp_path:
+        with tifffile.TiffWriter(tmp_path, bigtiff=image_array.nbytes >= 2**32 - 2**25) as tif:
+            level_array = image_array
+            level = 0
+            while True:
+                tif.write(_iter_tiles(level_array, tile_size),
+                            shape=level_array.shape, dtype=np.uint8,
+                            tile=(tile_size, tile_size), photometric='rgb', compression=compression,
+                            subfiletype=0 if level == 0 else 1)
+                if max(level_array.shape[:2]) <= tile_size:
+                    break
+                level_array = np.asarray(Image.fromarray(level_array).reduce(2))
+                level += 1
+
+
+def get_tiled_tiff_level_dimensions(filepath):
+    tifffile = _import_tifffile()
+    with tifffile.TiffFile(filepath) as tif:
+        return [(page.imagewidth, page.imagelength) for page in tif.pages]
+
+
+def read_tiled_tiff_region(filepath, location, size, level=0):
+    """
+    Read an (H, W, 3) region of a tiled TIFF level, decoding only the tiles it overlaps.
+    location is in the coordinates of the level, the parts outside of the image are left black.
+    """
+    tifffile = _import_tifffile()
+    image_array = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    with tifffile.TiffFile(filepath) as tif:
+        page = tif.pages[level]
+        tile_width, tile_height = page.tilewidth, page.tilelength
+        if not page.is_tiled:
+            raise ValueError(f'{filepath} level {level} is not tiled')
+        tiles_across = math.ceil(page.imagewidth / tile_width)
+
+        x0, y0 = max(location[0], 0), max(location[1], 0)
+        x1, y1 = min(location[0]+size[0], page.imagewidth), min(location[1]+size[1], page.imagelength)
+        for tile_y in range(y0 // tile_height, math.ceil(y1 / tile_height) if y1 > y0 else 0):
+            for tile_x in range(x0 // tile_width, math.ceil(x1 / tile_width) if x1 > x0 else 0):
+                index = tile_y * tiles_across + tile_x
+                tif.filehandle.seek(page.dataoffsets[index])
+                data = tif.filehandle.read(page.databytecounts[index])
+                tile, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+                tile = tile.reshape(tile_height, tile_width, -1)
+
+                # intersection of the tile with the requested region, in level coordinates
+                left, top = max(tile_x*tile_width, x0), max(tile_y*tile_height, y0)
+                right, bottom = min((tile_x+1)*tile_width, x1), min((tile_y+1)*tile_height, y1)
+                image_array[top-location[1]:bottom-location[1], left-location[0]:right-location[0]] = \
+                    tile[top-tile_y*tile_height:bottom-tile_y*tile_height, left-tile_x*tile_width:right-tile_x*tile_width, :3]
+    return image_array
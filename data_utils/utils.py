@@ -1,61 +1,289 @@
 import os
 from os.path import join as pjoin
-import xml
+import array
+from contextlib import contextmanager
 import datetime
+import hashlib
+import json
+import math
+from xml.etree import ElementTree
+import numpy as np
 import openslide
+from PIL import Image
 
-from data_config import *
+from .data_config import *
+from .catalog import DatasetCatalog
+from . import metrics
 
 
-def get_dataset_item_list(root=ARGS_raw_dir):
-    def __dataset_walk(root, folder):
-        try:
-            folder_contents = os.listdir(pjoin(root, folder))
-        except NotADirectoryError:
-            return [folder]
-        else:
-            ret_items = []
-            for path in folder_contents:
-                ret_items.extend(__dataset_walk(root, pjoin(folder, path)))
-        return ret_items
-    
-    folder_contents = os.listdir(root)
-    ret_items = []
-    for path in folder_contents:
-        ret_items.extend(__dataset_walk(root, path))
-    return ret_items
+_catalogs = {}
+
+
+def get_catalog(root=ARGS_raw_dir):
+    """
+    Per-process DatasetCatalog of root, refreshed when first used in the process.
+    SQLite connections must not cross a fork, hence the pid in the key.
+    """
+    key = (os.getpid(), root)
+    if key not in _catalogs:
+        _catalogs[key] = DatasetCatalog(root)
+    return _catalogs[key]
+
+
+def get_dataset_item_list(root=ARGS_raw_dir, annotated=None, min_size=None, max_size=None, refresh=False):
+    catalog = get_catalog(root)
+    if refresh:
+        catalog.refresh()
+    return catalog.items(annotated=annotated, min_size=min_size, max_size=max_size)
 
 
 def get_raw_item_path_with_index(index):
-    dataset_item_list = get_dataset_item_list(ARGS_raw_dir)
-    return dataset_item_list[index]
+    return get_catalog(ARGS_raw_dir)[index]
 
 
 def open_slide(filepath):
-    full_path = pjoin(ARGS_raw_dir, filepath)
-    return openslide.open_slide(full_path)
+    return openslide.open_slide(get_raw_item_fullpath(filepath))
+
+
+def _count_source_tiles(slide_handle, location, level, size):
+    """
+    Number of tiles of the slide file at `level` that a read_region overlaps, the tiles OpenSlide has to
+    decode unless they are still in its own cache. Nothing is counted for formats without a tile grid.
+    """
+    properties = slide_handle.properties
+    tile_width = properties.get(f'openslide.level[{level}].tile-width')
+    tile_height = properties.get(f'openslide.level[{level}].tile-height')
+    if tile_width is None or tile_height is None:
+        return
+    tile_width, tile_height = int(tile_width), int(tile_height)
+    downsample = slide_handle.level_downsamples[level]
+    level_width, level_height = slide_handle.level_dimensions[level]
+    x0, y0 = max(location[0] / downsample, 0), max(location[1] / downsample, 0)
+    x1, y1 = min(location[0] / downsample + size[0], level_width), min(location[1] / downsample + size[1], level_height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    columns = math.ceil(x1 / tile_width) - math.floor(x0 / tile_width)
+    rows = math.ceil(y1 / tile_height) - math.floor(y0 / tile_height)
+    metrics.count('source_tiles', columns * rows)
+
+
+def read_region_rgba(slide_handle, location, level, size):
+    """
+    read_region of an OpenSlide handle as an RGBA PIL image, timed and counted when metrics are enabled:
+    read_region_calls, decoded_bytes (of the RGBA output) and the overlapped source_tiles.
+    """
+    with metrics.timer('read_region'):
+        region = slide_handle.read_region(location=tuple(location), level=level, size=tuple(size))
+    if metrics.is_enabled():
+        metrics.count('read_region_calls')
+        metrics.count('decoded_bytes', size[0]*size[1]*4)
+        _count_source_tiles(slide_handle, location, level, size)
+    return region
+
+
+def read_region_array(slide_handle, location, level, size, out=None):
+    """
+    read_region of an OpenSlide handle as an (H, W, 3) uint8 array, dropping the alpha channel in NumPy
+    instead of converting through PIL. Writes into `out` when given.
+    """
+    rgba_array = np.asarray(read_region_rgba(slide_handle, location, level, size))
+    if out is None:
+        return np.ascontiguousarray(rgba_array[:, :, :3])
+    out[...] = rgba_array[:, :, :3]
+    return out
+
+
+def get_raw_item_fullpath(filepath):
+    return pjoin(ARGS_raw_dir, filepath)
+
+
+def _cache_path(kind, fullpath, extension):
+    key = hashlib.md5(os.path.abspath(fullpath).encode('utf-8')).hexdigest()
+    return pjoin(ARGS_cache_dir, kind, f'{key}.{extension}')
+
+
+def _slide_metadata_cache_path(filepath):
+    return _cache_path('metadata', get_raw_item_fullpath(filepath), 'json')
+
+
+def load_slide_metadata(filepath):
+    """
+    Return the cached metadata of a slide, or None when there is no cache entry
+    or the slide file changed (mtime/size) since it was written.
+    """
+    cache_path = _slide_metadata_cache_path(filepath)
+    try:
+        with open(cache_path) as f:
+            metadata = json.load(f)
+        stat = os.stat(get_raw_item_fullpath(filepath))
+    except (OSError, ValueError):
+        return None
+    if metadata.get('mtime') != stat.st_mtime or metadata.get('size') != stat.st_size:
+        return None
+    return metadata
+
+
+def save_slide_metadata(filepath, metadata):
+    stat = os.stat(get_raw_item_fullpath(filepath))
+    metadata = dict(metadata, path=get_raw_item_fullpath(filepath), mtime=stat.st_mtime, size=stat.st_size)
+    cache_path = _slide_metadata_cache_path(filepath)
+    try:
+        exists_or_makedirs(os.path.dirname(cache_path))
+        atomic_write_json(cache_path, metadata)
+    except OSError as e:
+        print(f'Failed to cache metadata of {filepath}: {e!r}')
+    return metadata
+
+
+@contextmanager
+def atomic_path(filepath):
+    """
+    Yield a temporary path next to filepath, renamed to filepath when the block completes and removed
+    when it raises, so that an interrupted job never leaves a partial file behind.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_write_json(filepath, obj):
+    with atomic_path(filepath) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+
+
+def atomic_save_image(image, filepath):
+    extension = os.path.splitext(filepath)[1].lower()
+    with atomic_path(filepath) as tmp_path:
+        image.save(tmp_path, format=Image.registered_extensions()[extension])
+
+
+def file_checksum(filepath, chunk_size=1024*1024):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_annotation_fullpath(filepath):
+    return pjoin(ARGS_annotation_dir, os.path.splitext(filepath)[0]+'.xml')
+
+
+def parse_annotation(fullpath):
+    """
+    Stream an ASAP annotation XML into flat arrays: all coordinates in one float32 (N, 2) array
+    with annotation i owning coordinates[offsets[i]:offsets[i+1]].
+    """
+    group_names, group_parents = [], []
+    annotation_names, annotation_types, annotation_parents = [], [], []
+    offsets = [0]
+    coordinates = array.array('f')
+    for _, element in ElementTree.iterparse(fullpath, events=('end',)):
+        if element.tag == 'Coordinate':
+            coordinates.append(float(element.get('X')))
+            coordinates.append(float(element.get('Y')))
+            element.clear()
+        elif element.tag == 'Annotation':
+            annotation_names.append(element.get('Name', ''))
+            annotation_types.append(element.get('Type', ''))
+            annotation_parents.append(element.get('PartOfGroup', ''))
+            offsets.append(len(coordinates) // 2)
+            element.clear()
+        elif element.tag == 'Group':
+            group_names.append(element.get('Name', ''))
+            group_parents.append(element.get('PartOfGroup', ''))
+            element.clear()
+
+    return {'group_names': np.array(group_names, dtype=str),
+            'group_parents': np.array(group_parents, dtype=str),
+            'annotation_names': np.array(annotation_names, dtype=str),
+            'annotation_types': np.array(annotation_types, dtype=str),
+            'annotation_parents': np.array(annotation_parents, dtype=str),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'coordinates': np.frombuffer(coordinates, dtype=np.float32).reshape(-1, 2)}
 
 
 def open_annotation(filepath):
-    filepath = os.path.splitext(filepath)[0]+'.xml'
-    fullpath = pjoin(ARGS_annotation_dir, filepath)
-    dom_tree = xml.dom.minidom.parse(fullpath)
-    root_node = dom_tree.documentElement
-    return root_node
+    """
+    Parsed annotation of a slide, read from the .npz cache when the XML did not change (mtime/size).
+    """
+    fullpath = get_annotation_fullpath(filepath)
+    stat = os.stat(fullpath)
+    cache_path = _cache_path('annotations', fullpath, 'npz')
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if cache['source_mtime'] == stat.st_mtime and cache['source_size'] == stat.st_size:
+                return {key: cache[key] for key in cache.files if not key.startswith('source_')}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with metrics.timer('parse_annotation'):
+        annotation = parse_annotation(fullpath)
+    metrics.count('annotation_bytes_parsed', stat.st_size)
+    try:
+        exists_or_makedirs(os.path.dirname(cache_path))
+        with atomic_path(cache_path) as tmp_path:
+            # through a file object, np.savez would append .npz to a path
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, source_mtime=stat.st_mtime, source_size=stat.st_size, **annotation)
+    except OSError as e:
+        print(f'Failed to cache annotation of {filepath}: {e!r}')
+    return annotation
 
 
 def get_converted_dir_by_scale_factor(scale_factor):
     return pjoin(ARGS_dataset_dir, 'preprocessed', ARGS_dataset_chosen, f'{scale_factor}X')
 
 
+def get_grid_positions(level_dimensions, downsample, patch_size, stride):
+    """
+    Level-0 upper-left corners, as an (N, 2) int64 array, of the patch_size grid with the given stride
+    over a level of size level_dimensions and the given downsample, row by row.
+    """
+    level_width, level_height = level_dimensions
+    xs = np.arange(0, level_width - patch_size + 1, stride)
+    ys = np.arange(0, level_height - patch_size + 1, stride)
+    grid = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+    return np.round(grid * downsample).astype(np.int64)
+
+
+def get_window_fractions(mask, mask_scale, upper_lefts, window_size):
+    """
+    Fraction of True pixels of a low-resolution mask inside level-0 windows.
+
+    mask_scale is the (x, y) level-0 size of one mask pixel, upper_lefts an (N, 2) array of
+    level-0 positions and window_size the level-0 (width, height) of every window. Windows are
+    widened to the mask pixels they touch.
+    """
+    import cv2
+    integral = cv2.integral(mask.astype(np.uint8)).astype(np.int64)
+    mask_height, mask_width = mask.shape
+    upper_lefts = np.asarray(upper_lefts, dtype=np.float64).reshape(-1, 2)
+    x0 = np.clip(np.floor(upper_lefts[:, 0] / mask_scale[0]).astype(np.int64), 0, mask_width-1)
+    y0 = np.clip(np.floor(upper_lefts[:, 1] / mask_scale[1]).astype(np.int64), 0, mask_height-1)
+    x1 = np.clip(np.ceil((upper_lefts[:, 0] + window_size[0]) / mask_scale[0]).astype(np.int64), x0+1, mask_width)
+    y1 = np.clip(np.ceil((upper_lefts[:, 1] + window_size[1]) / mask_scale[1]).astype(np.int64), y0+1, mask_height)
+    area = (x1 - x0) * (y1 - y0)
+    return (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]) / area
+
+
 def exists_or_makedirs(filepath):
     if not os.path.exists(filepath):
-        os.makedirs(filepath)
+        os.makedirs(filepath, exist_ok=True)
         return False
     else:
         return True
 
 
+def get_physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
 class Time:
   """
   Class for displaying elapsed time.